@@ -0,0 +1,300 @@
+"""Deterministic stand-ins for yt-dlp, FFmpeg and Discord used by the benchmarks
+
+install() swaps them in, so it has to be called before any song is
+searched for or played. Nothing here touches the network or spawns a process.
+"""
+import asyncio
+import os
+import threading
+import time
+import types
+
+import discord
+import yt_dlp
+
+FRAME_BYTES = 3840
+
+
+class Settings:
+    """Knobs for the fakes, changed through install()"""
+    extract_latency = 0.05  # Seconds per search or lookup
+    download_latency = 0.2  # Extra seconds per download
+    file_size = 64 * 1024  # Bytes written per downloaded song
+    track_frames = 50  # 20ms frames in every song
+    frame_interval = 0.0  # Seconds the voice client waits between frames, 0.02 is real time
+    open_latency = 0.05  # Seconds FFmpeg takes to start and produce its first frame
+    loudness = None  # LUFS every song measures at, None for right on the target
+    playlist_size = 200
+    timed_voice = False  # Play with a timer on the loop instead of a thread per voice client
+
+
+def video_info(video_id):
+    return {
+        'id': video_id,
+        'title': f"Fake Song {video_id}",
+        'duration': Settings.track_frames // 50,
+        'thumbnail': None,
+        'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+        'url': f"https://media.example/{video_id}",
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+        'acodec': 'opus',
+        'ext': 'opus',
+        'filesize': Settings.file_size,
+        'http_headers': {'User-Agent': 'fake'},
+    }
+
+
+def video_id_for(text):
+    return ''.join(c if c.isalnum() else '_' for c in text)[:11].ljust(11, '_')
+
+
+class FakeYoutubeDL:
+    """Answers searches, lookups, playlists and downloads after a fixed delay"""
+    
+    def __init__(self, options=None):
+        self.options = self.params = options or {}
+        self.cookiejar = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        pass
+    
+    def extract_info(self, url, download=False, ie_key=None, process=True, **kwargs):
+        time.sleep(Settings.extract_latency)
+        
+        if 'list=' in url:
+            entries = (
+                {
+                    '_type': 'url',
+                    'ie_key': 'Youtube',
+                    'id': f"pl{i:09d}",
+                    'url': f"https://www.youtube.com/watch?v=pl{i:09d}",
+                    'title': f"Playlist Song {i}",
+                    'duration': Settings.track_frames // 50,
+                }
+                for i in range(Settings.playlist_size)
+            )
+            return {'_type': 'playlist', 'title': 'Fake Playlist', 'entries': entries if not process else list(entries)}
+        
+        if ':' in url and not url.startswith('http'):
+            query = url.split(':', 1)[1]
+            return {'_type': 'playlist', 'entries': [self.info(video_id_for(query), download)]}
+        
+        return self.info(url.split('v=')[-1].split('&')[0], download)
+    
+    def process_ie_result(self, info, download=False):
+        return self.extract_info(info.get('webpage_url') or info['url'], download)
+    
+    def info(self, video_id, download):
+        info = video_info(video_id)
+        if download:
+            time.sleep(Settings.download_latency)
+            path = self.prepare_filename(info)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'\0' * Settings.file_size)
+            info['filepath'] = path
+            info['requested_downloads'] = [{'filepath': path}]
+        return info
+    
+    def prepare_filename(self, info):
+        template = self.options.get('outtmpl', '%(extractor)s-%(id)s.%(ext)s')
+        if isinstance(template, dict):
+            template = template.get('default')
+        return os.path.join(self.options.get('paths', {}).get('home', ''), template % info)
+
+
+class FakeAudioSource(discord.AudioSource):
+    """Produces a fixed number of silent opus frames without FFmpeg"""
+    
+    def __init__(self, source, *, codec=None, **kwargs):
+        self.remaining = Settings.track_frames
+        self.opened = False
+    
+    @classmethod
+    async def probe(cls, source, *, method=None, executable=None):
+        return 'opus', 128
+    
+    def read(self):
+        if not self.opened:
+            time.sleep(Settings.open_latency)
+            self.opened = True
+        if self.remaining <= 0:
+            return b''
+        self.remaining -= 1
+        return b'\0' * FRAME_BYTES
+    
+    def is_opus(self):
+        return True
+
+
+def fake_analyze(path):
+    """Loudness of every fake song, right on target unless Settings.loudness says otherwise"""
+    from cogs import loudness
+    lufs = loudness.LOUDNESS_TARGET if Settings.loudness is None else Settings.loudness
+    return {'lufs': lufs, 'peak': -20.0}
+
+
+class FakeVoiceClient:
+    """Plays sources on a thread like discord's AudioPlayer and records when"""
+    
+    def __init__(self, channel):
+        self.channel = channel
+        self.connected = True
+        self.source = None
+        self.after = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = []  # perf_counter of every play()
+        self.modes = []  # How every source given to play() was played
+        self.audible = []  # perf_counter of the first frame sent from every source
+        self.ended = []  # perf_counter of every song finishing or being stopped
+    
+    def is_connected(self):
+        return self.connected
+    
+    def is_playing(self):
+        return self.thread is not None and self.thread.is_alive() and not self.stopped.is_set()
+    
+    def is_paused(self):
+        return False
+    
+    def play(self, source, *, after=None):
+        self.source = source
+        self.after = after
+        self.modes.append(getattr(source, 'mode', None))
+        self.stopped = threading.Event()
+        self.started.append(time.perf_counter())
+        self.thread = threading.Thread(target=self.run, args=(after, self.stopped), daemon=True)
+        self.thread.start()
+    
+    def run(self, after, stopped):
+        # Read from self.source every frame, it can be swapped while playing
+        source, playing = self.source, None
+        while not stopped.is_set():
+            source = self.source
+            if not source.read():
+                break
+            if source is not playing:
+                self.audible.append(time.perf_counter())
+                playing = source
+            if Settings.frame_interval:
+                time.sleep(Settings.frame_interval)
+        
+        self.ended.append(time.perf_counter())
+        if after:
+            after(None)
+        source.cleanup()
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+    
+    def pause(self):
+        pass
+    
+    def resume(self):
+        pass
+    
+    async def disconnect(self, **kwargs):
+        self.stop()
+        self.connected = False
+
+
+class TimedVoiceClient(FakeVoiceClient):
+    """Lets a song's length pass on a loop timer, for simulating thousands of voice clients"""
+    
+    def __init__(self, channel):
+        super().__init__(channel)
+        self.handle = None
+    
+    def is_playing(self):
+        return self.handle is not None
+    
+    def play(self, source, *, after=None):
+        self.source = source
+        self.after = after
+        self.modes.append(getattr(source, 'mode', None))
+        self.started.append(time.perf_counter())
+        self.audible.append(self.started[-1])
+        length = Settings.track_frames * 0.02
+        self.handle = asyncio.get_running_loop().call_later(length, self.finish)
+    
+    def finish(self):
+        self.handle = None
+        self.ended.append(time.perf_counter())
+        if self.after:
+            self.after(None)
+        self.source.cleanup()
+    
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.finish()
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+    
+    async def edit(self, content=None, embed=None, **kwargs):
+        self.content = content
+        self.embed = embed
+
+
+class FakeChannel:
+    def __init__(self, channel_id, name='fake'):
+        self.id = channel_id
+        self.name = name
+        self.sent = 0
+    
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, content, embed)
+    
+    async def connect(self, **kwargs):
+        if Settings.timed_voice:
+            return TimedVoiceClient(self)
+        return FakeVoiceClient(self)
+
+
+class FakeBot:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.user = types.SimpleNamespace(id=1)
+    
+    async def wait_until_ready(self):
+        pass
+    
+    def is_closed(self):
+        return False
+
+
+def make_context(bot, guild_id, member_id=1000):
+    """A command context for a member sitting in a voice channel"""
+    member = types.SimpleNamespace(id=member_id, mention=f"<@{member_id}>")
+    member.voice = types.SimpleNamespace(channel=FakeChannel(guild_id * 10 + 1, 'voice'))
+    guild = types.SimpleNamespace(id=guild_id, name=f"guild-{guild_id}", get_member=lambda i: member)
+    channel = FakeChannel(guild_id * 10)
+    return types.SimpleNamespace(bot=bot, guild=guild, channel=channel, author=member, send=channel.send)
+
+
+def install(**settings):
+    """Swap the fakes in for yt-dlp and FFmpeg, applying any Settings given"""
+    for name, value in settings.items():
+        if not hasattr(Settings, name):
+            raise TypeError(f"unknown fake setting: {name}")
+        setattr(Settings, name, value)
+    
+    from cogs import loudness
+    
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    discord.FFmpegOpusAudio = FakeAudioSource
+    discord.FFmpegPCMAudio = FakeAudioSource
+    loudness.analyze = fake_analyze
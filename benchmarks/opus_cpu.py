@@ -0,0 +1,114 @@
+"""Measure CPU cost per stream of the PCM, opus passthrough and transcode playback paths
+
+Usage:
+python -m benchmarks.opus_cpu [audio file] [--seconds N]
+
+Without an audio file a test tone is generated with FFmpeg, encoded the
+same way the FFmpegExtractAudio postprocessor writes downloads. Every path
+decodes the whole file as fast as possible, so the numbers are CPU seconds
+spent per minute of audio for one stream. Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import discord
+
+from cogs.music import FFMPEG_OPTIONS
+
+FRAME_SECONDS = 0.02
+
+
+def make_test_file(directory, seconds):
+    """Write an opus test tone like the ones our downloads end up as"""
+    path = os.path.join(directory, 'tone.opus')
+    subprocess.run(
+        [
+            'ffmpeg', '-loglevel', 'error', '-y',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+            '-ac', '2', '-c:a', 'libopus', '-b:a', '128k', path,
+        ],
+        check=True,
+    )
+    return path
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_path(name, source, encoder=None):
+    """Drain a source like the voice client would and time it"""
+    process_start = time.process_time()
+    children_start = children_cpu()
+    wall_start = time.perf_counter()
+    frames = 0
+    
+    while True:
+        data = source.read()
+        if not data:
+            break
+        if encoder is not None:
+            # What discord.py's AudioPlayer does for every non-opus frame
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        frames += 1
+    
+    source.cleanup()
+    
+    audio_minutes = frames * FRAME_SECONDS / 60 or 1
+    bot_cpu = time.process_time() - process_start
+    ffmpeg_cpu = children_cpu() - children_start
+    
+    return {
+        'path': name,
+        'frames': frames,
+        'wall_seconds': round(time.perf_counter() - wall_start, 3),
+        'bot_cpu_per_audio_minute': round(bot_cpu / audio_minutes, 4),
+        'ffmpeg_cpu_per_audio_minute': round(ffmpeg_cpu / audio_minutes, 4),
+        'total_cpu_per_audio_minute': round((bot_cpu + ffmpeg_cpu) / audio_minutes, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file', nargs='?', help='audio file to play (default: generated tone)')
+    parser.add_argument('--seconds', type=int, default=120, help='length of the generated tone')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        audio_file = args.file or make_test_file(directory, args.seconds)
+        codec, _ = asyncio.run(discord.FFmpegOpusAudio.probe(audio_file, method='fallback'))
+        
+        results = []
+        
+        if discord.opus.is_loaded() or discord.opus._load_default():
+            results.append(run_path(
+                'pcm',
+                discord.FFmpegPCMAudio(audio_file, **FFMPEG_OPTIONS),
+                encoder=discord.opus.Encoder(),
+            ))
+        else:
+            print('libopus not found, skipping the pcm path', file=sys.stderr)
+        
+        results.append(run_path(
+            'passthrough' if codec in ('opus', 'libopus') else 'transcode',
+            discord.FFmpegOpusAudio(audio_file, codec=codec, **FFMPEG_OPTIONS),
+        ))
+        # Any codec but opus makes FFmpeg encode, 'libopus' would be copied
+        results.append(run_path(
+            'transcode',
+            discord.FFmpegOpusAudio(audio_file, codec=None, **FFMPEG_OPTIONS),
+        ))
+    
+    print(json.dumps({'file': args.file or 'generated', 'codec': codec, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
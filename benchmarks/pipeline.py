@@ -0,0 +1,301 @@
+"""Benchmark the music pipeline offline, with fake yt-dlp, FFmpeg and voice
+
+Usage:
+python -m benchmarks.pipeline [--players N] [--songs N] [--extract-latency S] ...
+
+Drives the real Music cog and player loop through play, skip, loop, seek
+and stop with the fakes from benchmarks.fakes, so the numbers only depend on
+the bot's own code and the configured fake latencies. It also replays a song
+whose loudness needs correcting, to show how each play of it is served.
+Results are printed as JSON, run it on two commits and diff the output to
+compare them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import fakes
+
+
+def summary(values):
+    """Milliseconds percentiles of a list of durations in seconds"""
+    if not values:
+        return None
+    values = sorted(values)
+    
+    def percentile(p):
+        return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 3)
+    
+    return {
+        'count': len(values),
+        'mean_ms': round(statistics.fmean(values) * 1000, 3),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'max_ms': round(values[-1] * 1000, 3),
+    }
+
+
+async def wait_for(condition, timeout=60):
+    """Poll until condition() is true, the fakes signal from threads so there is nothing to await"""
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError('benchmark step did not finish in time')
+        await asyncio.sleep(0.001)
+
+
+class Bench:
+    def __init__(self, music, args):
+        self.music = music
+        self.args = args
+        self.bot = fakes.FakeBot()
+        self.cog = music.Music(self.bot)
+        self.next_guild = 1
+    
+    def context(self):
+        ctx = fakes.make_context(self.bot, self.next_guild)
+        self.next_guild += 1
+        return ctx
+    
+    async def play(self, ctx, query):
+        await self.music.Music.play.callback(self.cog, ctx, query=query)
+    
+    def player(self, ctx):
+        return self.cog.players[ctx.guild.id]
+    
+    async def time_to_first_audio(self):
+        """Every player starts one new song at the same time"""
+        async def first_audio(ctx, i):
+            start = time.perf_counter()
+            await self.play(ctx, f"first audio {i}")
+            player = self.player(ctx)
+            await wait_for(lambda: player.voice_client and player.voice_client.started)
+            return player.voice_client.started[0] - start
+        
+        contexts = [self.context() for _ in range(self.args.players)]
+        return summary(await asyncio.gather(*(first_audio(ctx, i) for i, ctx in enumerate(contexts))))
+    
+    async def track_gap(self):
+        """Silence between songs of a queue that is prefetched ahead"""
+        # Play in real time so the next song can be opened during this one
+        fakes.Settings.frame_interval = 0.02
+        
+        ctx = self.context()
+        for i in range(self.args.songs):
+            await self.play(ctx, f"gap {i}")
+        
+        voice = self.player(ctx).voice_client
+        await wait_for(lambda: len(voice.ended) >= self.args.songs)
+        fakes.Settings.frame_interval = self.args.frame_interval
+        return summary([start - end for end, start in zip(voice.ended, voice.audible[1:])])
+    
+    async def enqueue(self):
+        """How fast songs and playlists get onto the queue"""
+        ctx = self.context()
+        await self.play(ctx, 'warm up')
+        
+        start = time.perf_counter()
+        for i in range(self.args.songs):
+            await self.play(ctx, f"enqueue {i}")
+        songs_seconds = time.perf_counter() - start
+        
+        ctx = self.context()
+        start = time.perf_counter()
+        await self.play(ctx, 'https://www.youtube.com/playlist?list=PLBENCH')
+        player = self.player(ctx)
+        await wait_for(lambda: not player.playlist_tasks)
+        playlist_seconds = time.perf_counter() - start
+        
+        return {
+            'songs_per_second': round(self.args.songs / songs_seconds, 2),
+            'playlist_songs': fakes.Settings.playlist_size,
+            'playlist_songs_per_second': round(fakes.Settings.playlist_size / playlist_seconds, 2),
+        }
+    
+    async def controls(self):
+        """Latency of skip, song loop and stop"""
+        # Play in real time so there is a song to skip
+        fakes.Settings.frame_interval = 0.02
+        
+        ctx = self.context()
+        for i in range(4):
+            await self.play(ctx, f"controls {i}")
+        voice = self.player(ctx).voice_client
+        
+        skips = []
+        for _ in range(2):
+            await wait_for(voice.is_playing)
+            played = len(voice.started)
+            start = time.perf_counter()
+            await self.music.Music.skip.callback(self.cog, ctx)
+            await wait_for(lambda: len(voice.started) > played)
+            skips.append(voice.started[-1] - start)
+        fakes.Settings.frame_interval = self.args.frame_interval
+        
+        await self.music.Music.loop.callback(self.cog, ctx, 'song')
+        played = len(voice.started)
+        await wait_for(lambda: len(voice.started) >= played + 3)
+        loops = [start - end for end, start in zip(voice.ended[played - 1:], voice.started[played:])]
+        await self.music.Music.loop.callback(self.cog, ctx, 'off')
+        
+        start = time.perf_counter()
+        await self.music.Music.stop.callback(self.cog, ctx)
+        stop_seconds = time.perf_counter() - start
+        
+        return {
+            'skip_to_next_audio': summary(skips),
+            'song_loop_gap': summary(loops),
+            'stop_ms': round(stop_seconds * 1000, 3),
+        }
+    
+    async def seek(self):
+        """Latency from !seek to hearing the song from the new position"""
+        fakes.Settings.frame_interval = 0.02
+        track_frames = fakes.Settings.track_frames
+        fakes.Settings.track_frames = 60 * 50
+        
+        ctx = self.context()
+        await self.play(ctx, 'seek song')
+        voice = self.player(ctx).voice_client
+        await wait_for(lambda: voice and voice.audible)
+        
+        seeks = []
+        for position in ('0:30', '0:10', '0:50'):
+            heard = len(voice.audible)
+            start = time.perf_counter()
+            await self.music.Music.seek.callback(self.cog, ctx, position)
+            await wait_for(lambda: len(voice.audible) > heard)
+            seeks.append(voice.audible[-1] - start)
+        
+        await self.music.Music.stop.callback(self.cog, ctx)
+        fakes.Settings.track_frames = track_frames
+        fakes.Settings.frame_interval = self.args.frame_interval
+        return summary(seeks)
+    
+    async def normalized_replay(self):
+        """How a song far from the loudness target is played each time it is queued again"""
+        fakes.Settings.loudness = -20.0
+        plays = 5
+        
+        ctx = self.context()
+        for _ in range(plays):
+            await self.play(ctx, 'quiet song')
+        voice = self.player(ctx).voice_client
+        await wait_for(lambda: len(voice.ended) >= plays)
+        fakes.Settings.loudness = None
+        
+        modes = {mode: voice.modes.count(mode) for mode in sorted(set(voice.modes))}
+        song = self.player(ctx).current
+        stores = [key for key in self.music.audio_cache.entries if key.startswith(f"{song.cache_key}.")]
+        return {
+            'plays': plays,
+            'modes': modes,
+            'gain_db': self.player(ctx).normalization(song),
+            'frame_stores': sorted(stores),
+        }
+    
+    async def players(self):
+        """CPU and memory per player, each playing through its own queue"""
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        
+        contexts = [self.context() for _ in range(self.args.players)]
+        for ctx in contexts:
+            for i in range(self.args.songs):
+                await self.play(ctx, f"player {ctx.guild.id} song {i}")
+        
+        voices = [self.player(ctx).voice_client for ctx in contexts]
+        await wait_for(lambda: all(len(voice.ended) >= self.args.songs for voice in voices))
+        
+        cpu = time.process_time() - cpu_start
+        memory, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        return {
+            'players': self.args.players,
+            'songs_each': self.args.songs,
+            'wall_seconds': round(time.perf_counter() - wall_start, 3),
+            'cpu_ms_per_player': round(cpu / self.args.players * 1000, 3),
+            'cpu_ms_per_song': round(cpu / (self.args.players * self.args.songs) * 1000, 3),
+            'memory_bytes_per_player': int((memory - baseline) / self.args.players),
+            'peak_memory_bytes_per_player': int((peak - baseline) / self.args.players),
+        }
+
+
+async def run(args):
+    from cogs import music
+    
+    bench = Bench(music, args)
+    await bench.cog.cog_load()
+    
+    results = {}
+    try:
+        for name in args.scenarios:
+            results[name] = await getattr(bench, name)()
+    finally:
+        for player in list(bench.cog.players.values()):
+            player.clear()
+        await bench.cog.cog_unload()
+        # Downloads and analyses nobody waits for anymore still finish in the
+        # background and write to the cache, which is about to be deleted
+        await wait_for(lambda: not music.loudness_analyzer.pending and not (
+            music.download_executor.stats()['queued'] or music.download_executor.stats()['running']
+        ))
+    
+    results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+SCENARIOS = ['time_to_first_audio', 'track_gap', 'enqueue', 'controls', 'seek', 'normalized_replay', 'players']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=20, help='guilds playing at once')
+    parser.add_argument('--songs', type=int, default=10, help='songs queued per guild')
+    parser.add_argument('--extract-latency', type=float, default=0.05, help='seconds per fake search')
+    parser.add_argument('--download-latency', type=float, default=0.2, help='extra seconds per fake download')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='bytes per fake download')
+    parser.add_argument('--track-frames', type=int, default=50, help='20ms frames per fake song')
+    parser.add_argument('--open-latency', type=float, default=0.05, help='seconds before a fake FFmpeg\'s first frame')
+    parser.add_argument('--frame-interval', type=float, default=0.0, help='seconds between frames, 0.02 is real time')
+    parser.add_argument('--playlist-size', type=int, default=200, help='songs in the fake playlist')
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+                        help='run only this scenario, can be repeated')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or SCENARIOS
+    
+    with tempfile.TemporaryDirectory() as directory:
+        # Must be set before the cogs are imported, they read them at import
+        os.environ['AUDIO_CACHE_DIR'] = directory
+        os.environ['EXTRACTION_BACKEND'] = 'thread'
+        os.environ.setdefault('PLAYBACK_MODE', 'download')
+        
+        fakes.install(
+            extract_latency=args.extract_latency,
+            download_latency=args.download_latency,
+            file_size=args.file_size,
+            track_frames=args.track_frames,
+            frame_interval=args.frame_interval,
+            open_latency=args.open_latency,
+            playlist_size=args.playlist_size,
+        )
+        
+        results = asyncio.run(run(args))
+    
+    config = {key: value for key, value in vars(args).items()}
+    config['python'] = platform.python_version()
+    print(json.dumps({'config': config, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
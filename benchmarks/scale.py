@@ -0,0 +1,213 @@
+"""Simulate thousands of guilds using the music commands at once
+
+Usage:
+python -m benchmarks.scale [--guilds 1000 --guilds 5000 ...] [--duration S]
+
+Each simulated guild gets the real Music cog and its own MusicPlayer and
+sends a mix of !play, !q and !skip with idle time in between, against the
+fakes from benchmarks.fakes. While it runs, the event loop lag, number of
+asyncio tasks, RSS and extraction pool saturation are sampled. It also
+times bot.py's fallback channel scan over the same number of guilds, which
+random_message_task runs on the event loop. Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import types
+
+from benchmarks import fakes
+from benchmarks.pipeline import summary
+
+# Relative weight of each action a simulated guild takes
+ACTIONS = {
+    'play': 5,
+    'queue': 3,
+    'skip': 1,
+    'idle': 3,
+}
+
+
+def rss_bytes():
+    """Current resident memory, falling back to the peak where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Sampler:
+    """Samples loop lag, tasks and memory in the background"""
+    
+    def __init__(self, music, interval=0.01):
+        self.music = music
+        self.interval = interval
+        self.lags = []
+        self.tasks = []
+        self.rss = []
+        self.queued = {'search': 0, 'download': 0}
+    
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+            
+            if len(self.lags) % 10 == 0:
+                self.tasks.append(len(asyncio.all_tasks()))
+                self.rss.append(rss_bytes())
+                for executor in (self.music.search_executor, self.music.download_executor):
+                    self.queued[executor.name] = max(self.queued[executor.name], executor.stats()['queued'])
+
+
+async def guild(music, cog, ctx, deadline, think, songs, latencies):
+    """One guild's users, doing something every think seconds on average"""
+    names, weights = zip(*ACTIONS.items())
+    
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(min(random.expovariate(1 / think), max(0, deadline - time.perf_counter())))
+        action = random.choices(names, weights)[0]
+        start = time.perf_counter()
+        
+        if action == 'play':
+            # Popular songs are played far more often, like real charts
+            song = min(int(random.paretovariate(1.2)), songs)
+            await music.Music.play.callback(cog, ctx, query=f"popular song {song}")
+        elif action == 'queue':
+            await music.Music.queue.callback(cog, ctx)
+        elif action == 'skip':
+            await music.Music.skip.callback(cog, ctx)
+        else:
+            await asyncio.sleep(min(think * 3, max(0, deadline - time.perf_counter())))
+            continue
+        
+        latencies.setdefault(action, []).append(time.perf_counter() - start)
+
+
+def fallback_scan(guild_count):
+    """Time random_message_task's fallback channel scan in its worst case"""
+    os.environ.setdefault('DISCORD_TOKEN', 'simulated')
+    import bot
+    
+    denied = types.SimpleNamespace(send_messages=False)
+    allowed = types.SimpleNamespace(send_messages=True)
+    
+    def channel(perms):
+        return types.SimpleNamespace(permissions_for=lambda member: perms)
+    
+    # Only the last channel of the last guild can be written to
+    guilds = [
+        types.SimpleNamespace(me=object(), text_channels=[channel(denied) for _ in range(10)])
+        for _ in range(guild_count)
+    ]
+    guilds[-1].text_channels[-1] = channel(allowed)
+    client = types.SimpleNamespace(guilds=guilds, user=types.SimpleNamespace(id=1))
+    
+    start = time.perf_counter()
+    bot.find_fallback_channel(client)
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+async def simulate(guild_count, args):
+    from cogs import music
+    
+    fake_bot = fakes.FakeBot()
+    cog = music.Music(fake_bot)
+    await cog.cog_load()
+    
+    sampler = Sampler(music)
+    sampler_task = asyncio.create_task(sampler.run())
+    rss_start = rss_bytes()
+    tasks_start = len(asyncio.all_tasks())
+    
+    latencies = {}
+    deadline = time.perf_counter() + args.duration
+    contexts = [fakes.make_context(fake_bot, guild_id) for guild_id in range(1, guild_count + 1)]
+    
+    try:
+        await asyncio.gather(*(
+            guild(music, cog, ctx, deadline, args.think, args.songs, latencies) for ctx in contexts
+        ))
+        players = len(cog.players)
+        player_tasks = sum(1 for player in cog.players.values() if not player.task.done())
+        tasks_peak = max(sampler.tasks, default=tasks_start)
+    finally:
+        sampler_task.cancel()
+        for player in list(cog.players.values()):
+            player.clear()
+        await cog.cog_unload()
+    
+    rss_peak = max(sampler.rss, default=rss_start)
+    search = music.search_executor.stats()
+    download = music.download_executor.stats()
+    
+    return {
+        'guilds': guild_count,
+        'loop_lag': summary(sampler.lags),
+        'commands': {action: summary(values) for action, values in sorted(latencies.items())},
+        'players': players,
+        'player_tasks': player_tasks,
+        'tasks_start': tasks_start,
+        'tasks_peak': tasks_peak,
+        'rss_start_mb': round(rss_start / 2 ** 20, 1),
+        'rss_peak_mb': round(rss_peak / 2 ** 20, 1),
+        'rss_growth_kb_per_guild': round((rss_peak - rss_start) / 1024 / guild_count, 2),
+        'executors': {
+            'search_max_queued': sampler.queued['search'],
+            'search_max_wait_ms': search['max_wait_ms'],
+            'download_max_queued': sampler.queued['download'],
+            'download_max_wait_ms': download['max_wait_ms'],
+        },
+        'fallback_scan_ms': fallback_scan(guild_count),
+    }
+
+
+async def run(args):
+    return [await simulate(guild_count, args) for guild_count in args.guilds]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, action='append', help='guilds to simulate, can be repeated')
+    parser.add_argument('--duration', type=float, default=30, help='seconds each simulation runs')
+    parser.add_argument('--think', type=float, default=5, help='average seconds between a guild\'s commands')
+    parser.add_argument('--songs', type=int, default=500, help='distinct songs guilds pick from')
+    parser.add_argument('--track-seconds', type=float, default=30, help='length of every fake song')
+    parser.add_argument('--extract-latency', type=float, default=0.05, help='seconds per fake search')
+    parser.add_argument('--download-latency', type=float, default=0.2, help='extra seconds per fake download')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    args.guilds = args.guilds or [1000, 5000, 10000]
+    random.seed(args.seed)
+    
+    # Thousands of guilds log far too much at INFO, and bot.py's own logging
+    # setup does nothing once this has run
+    logging.basicConfig(level=logging.WARNING)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        # Must be set before the cogs are imported, they read them at import
+        os.environ['AUDIO_CACHE_DIR'] = directory
+        os.environ['EXTRACTION_BACKEND'] = 'thread'
+        os.environ['METADATA_CACHE_SIZE'] = str(max(args.songs * 2, 2048))
+        
+        fakes.install(
+            extract_latency=args.extract_latency,
+            download_latency=args.download_latency,
+            track_frames=int(args.track_seconds * 50),
+            file_size=1024,
+            timed_voice=True,
+        )
+        
+        results = asyncio.run(run(args))
+    
+    print(json.dumps({'config': vars(args), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Measure the memory held by a large queue of songs
+
+Usage:
+python -m benchmarks.song_memory [--tracks N]
+
+Fills a SongQueue with placeholder songs the way a flat playlist does and
+reports the memory traced while building it, compared with the old Song
+layout that had an instance __dict__ and held the requesting Member.
+Results are printed as JSON.
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from cogs.music import Song
+from cogs.music_queue import SongQueue
+
+
+class DictSong:
+    """The Song layout before it was slotted, for comparison"""
+    
+    def __init__(self, url, title, duration, thumbnail, requester, source='Unknown', filepath=None, cache_key=None,
+                 resolved=True):
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.requester = requester
+        self.source = source
+        self.filepath = filepath
+        self.cache_key = cache_key
+        self.resolved = resolved
+        self.stream_url = None
+        self.http_headers = None
+        self.stream_codec = None
+        self.stream_failed = False
+
+
+class FakeMember:
+    """Stands in for the discord.Member the old layout referenced"""
+    
+    def __init__(self, member_id):
+        self.id = member_id
+        self.mention = f"<@{member_id}>"
+
+
+def fill_queue(song_class, tracks, requester):
+    queue = SongQueue()
+    for i in range(tracks):
+        # Strings are built per track like ones parsed from yt-dlp's json
+        video_id = f"{i:011d}"
+        queue.append(song_class(
+            f"https://www.youtube.com/watch?v={video_id}",
+            f"Some Artist - Track Number {i} (Official Audio)",
+            200 + i % 100,
+            None,
+            requester,
+            ''.join(['Y', 'ouTube']),
+            cache_key=f"youtube-{video_id}",
+            resolved=False,
+        ))
+    return queue
+
+
+def measure(name, song_class, tracks, requester):
+    gc.collect()
+    tracemalloc.start()
+    queue = fill_queue(song_class, tracks, requester)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    song = queue[0]
+    record = sys.getsizeof(song)
+    if hasattr(song, '__dict__'):
+        record += sys.getsizeof(song.__dict__)
+    
+    return {
+        'layout': name,
+        'tracks': tracks,
+        'total_bytes': current,
+        'peak_bytes': peak,
+        'bytes_per_track': round(current / tracks, 1),
+        'record_bytes': record,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=100_000, help='number of songs to queue')
+    args = parser.parse_args()
+    
+    results = [
+        measure('dict', DictSong, args.tracks, FakeMember(1234567890)),
+        measure('slots', Song, args.tracks, 1234567890),
+    ]
+    
+    print(json.dumps({'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
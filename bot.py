@@ -5,6 +5,10 @@ import os
 import json
 import logging
 import random
+import time
+
+from cogs.metrics import command_errors_total, command_seconds
+from cogs.tracing import finish_trace, mark, start_trace
 
 # Setup logging
 logging.basicConfig(
@@ -67,20 +71,47 @@ async def on_message(message):
     if bot.user.mentioned_in(message) and message.mention_everyone is False:
         logger.info(f'Mentioned by {message.author} in {message.guild.name}')
     
-    await bot.process_commands(message)
+    # What bot.process_commands does, split up so tracing can time each step
+    trace = start_trace(message)
+    try:
+        ctx = await bot.get_context(message)
+        
+        if trace and ctx.command:
+            trace.command = ctx.command.qualified_name
+            trace.mark('parse')
+        
+        await bot.invoke(ctx)
+    finally:
+        finish_trace(trace)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+    # Checks and argument conversion run between parsing and this hook
+    mark('checks')
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    # Runs whether or not the command failed
+    command_seconds.observe(time.perf_counter() - ctx.started_at, command=ctx.command.qualified_name)
+    mark('command')
 
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
         return
-    elif isinstance(error, commands.MissingRequiredArgument):
+    
+    command = ctx.command.qualified_name if ctx.command else 'unknown'
+    command_errors_total.inc(command=command, error=type(getattr(error, 'original', error)).__name__)
+    
+    if isinstance(error, commands.MissingRequiredArgument):
         await ctx.send(f"missing argument: `{error.param.name}`")
     else:
         logger.error(f'error: {error}')
         await ctx.send(f"error: {str(error)}")
 
 async def load_cogs():
-    cogs = ['cogs.music', 'cogs.utility']
+    cogs = ['cogs.metrics', 'cogs.tracing', 'cogs.watchdog', 'cogs.music', 'cogs.utility']
     for cog in cogs:
         try:
             await bot.load_extension(cog)
@@ -93,6 +124,19 @@ async def main():
         await load_cogs()
         await bot.start(TOKEN)
 
+# helper to find a fallback channel if none configured
+def find_fallback_channel(client):
+    for guild in client.guilds:
+        for ch in guild.text_channels:
+            try:
+                # try a simple check by permissions; send in first writable channel
+                perms = ch.permissions_for(guild.me or guild.get_member(client.user.id))
+                if perms.send_messages:
+                    return ch
+            except Exception:
+                continue
+    return None
+
 async def random_message_task():
     await bot.wait_until_ready()
     # configuration: set RANDOM_CHANNEL_ID env var to target a specific channel id
@@ -141,21 +185,8 @@ async def random_message_task():
         "im up rn",
         ]
 
-    # helper to find a fallback channel if none configured
-    def find_fallback_channel():
-        for guild in bot.guilds:
-            for ch in guild.text_channels:
-                try:
-                    # try a simple check by permissions; send in first writable channel
-                    perms = ch.permissions_for(guild.me or guild.get_member(bot.user.id))
-                    if perms.send_messages:
-                        return ch
-                except Exception:
-                    continue
-        return None
-
     if channel is None:
-        channel = find_fallback_channel()
+        channel = find_fallback_channel(bot)
 
     # main loop: random sleep between 1 and 4 hours
     while not bot.is_closed():
@@ -164,7 +195,7 @@ async def random_message_task():
         await asyncio.sleep(interval)
 
         if channel is None:
-            channel = find_fallback_channel()
+            channel = find_fallback_channel(bot)
             if channel is None:
                 # nothing to send to; retry after next interval
                 continue
@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger('AudioCache')
+
+# Where downloaded songs are kept between plays
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'downloads')
+
+# Total size the cache may grow to before songs get evicted
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_MB', '2048')) * 1024 * 1024
+
+# 'lru' evicts the song played least recently, 'lfu' the one played least often
+AUDIO_CACHE_POLICY = os.getenv('AUDIO_CACHE_POLICY', 'lru').lower()
+
+INDEX_FILE = 'index.json'
+
+# Names of the files the cache keeps: downloads named <extractor>-<id>.<ext>
+# by yt-dlp, and frame stores named after their key
+CACHE_FILE_PATTERN = re.compile(r'^[\w:]+-[\w.+-]+\.(?:opus|mp3|m4a|webm|ogg|frames)$')
+
+def cache_key(info):
+    """Build the cache key for a yt-dlp info dict, matching the download filename"""
+    if not info:
+        return None
+    
+    extractor = info.get('extractor_key') or info.get('ie_key') or info.get('extractor')
+    video_id = info.get('id')
+    
+    if not extractor or not video_id:
+        return None
+    
+    return f"{extractor.lower()}-{video_id}"
+
+class AudioCache:
+    """Size bounded cache of downloaded songs keyed by extractor and id
+    
+    The index is saved as json next to the files so the cache survives
+    restarts. Songs that are playing or about to play are pinned and never
+    evicted. Methods that touch the disk block, so run them in an executor.
+    """
+    
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES, policy=AUDIO_CACHE_POLICY):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.entries = {}  # key -> {'path', 'size', 'last_used', 'hits', 'loudness' once analyzed}
+        self.pins = {}  # key -> number of players holding the file
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.save_lock = threading.Lock()  # Held while the index is written, saves come from many threads
+    
+    def load(self):
+        """Load the index from disk, dropping songs whose file is gone
+        
+        Without a readable index the songs are found again from their file
+        names, so the files aren't lost to the janitor as orphans.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        
+        rebuilt = False
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries, rebuilt = self.scan(), True
+        except Exception as e:
+            logger.error(f"could not read cache index, rebuilding it from the files: {e}")
+            entries, rebuilt = self.scan(), True
+        
+        with self.lock:
+            self.entries = {
+                key: entry for key, entry in entries.items()
+                if os.path.exists(entry['path'])
+            }
+            self.total_bytes = sum(entry['size'] for entry in self.entries.values())
+            self.dirty = rebuilt or len(self.entries) != len(entries)
+        
+        logger.info(f"audio cache: {len(self.entries)} songs, {self.total_bytes // (1024 * 1024)}MB")
+        self.evict()
+    
+    def scan(self):
+        """Index entries for the cache's own files in the directory (blocking)"""
+        entries = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file(follow_symlinks=False) or not CACHE_FILE_PATTERN.match(entry.name):
+                continue
+            
+            # Frame stores are keyed by their whole name, downloads without the extension
+            name, ext = os.path.splitext(entry.name)
+            key = entry.name if ext == '.frames' else name
+            stat = entry.stat(follow_symlinks=False)
+            entries[key] = {'path': entry.path, 'size': stat.st_size, 'last_used': stat.st_mtime, 'hits': 0}
+        
+        return entries
+    
+    def save(self):
+        """Write the index to disk if it changed"""
+        # Snapshots are taken and written one save at a time, so an older one
+        # can never replace a newer one or share its temporary file
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                snapshot = json.dumps(self.entries)
+                self.dirty = False
+            
+            # Write to a temporary file first so a crash never leaves a broken index
+            tmp_path = self.index_path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.index_path)
+            except Exception as e:
+                logger.error(f"could not save cache index: {e}")
+                # Try again on the next save
+                with self.lock:
+                    self.dirty = True
+    
+    def get(self, key):
+        """Get the file for a cached song and mark it as used, None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            
+            if entry is None or not os.path.exists(entry['path']):
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            
+            entry['last_used'] = time.time()
+            entry['hits'] += 1
+            self.hits += 1
+            self.dirty = True
+            return entry['path']
+    
+    def path(self, key):
+        """The file of a cached song without counting it as a use, None if not cached"""
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            return entry['path'] if entry else None
+    
+    def loudness(self, key):
+        """A cached song's loudness analysis, None if it hasn't been analyzed"""
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            return entry.get('loudness') if entry else None
+    
+    def has_loudness(self, key):
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            return entry is not None and 'loudness' in entry
+    
+    def set_loudness(self, key, loudness):
+        """Keep a song's loudness analysis in the index, next to its file"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['loudness'] = loudness
+            self.dirty = True
+        self.save()
+    
+    def add(self, key, path):
+        """Add a downloaded file to the cache, evicting others to make room"""
+        if not key or not path or not os.path.exists(path):
+            return
+        
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]['size']
+            
+            size = os.path.getsize(path)
+            self.entries[key] = {'path': path, 'size': size, 'last_used': time.time(), 'hits': 1}
+            self.total_bytes += size
+            self.dirty = True
+        
+        # The new song is about to be played, so never evict it straight away
+        self.evict(keep=key)
+        self.save()
+    
+    def remove(self, key):
+        """Forget a song and delete its file"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            self.total_bytes -= entry['size']
+            self.dirty = True
+        
+        try:
+            if os.path.exists(entry['path']):
+                os.remove(entry['path'])
+        except Exception as e:
+            logger.error(f"Could not delete file: {e}")
+    
+    def paths(self):
+        """Files of every cached song"""
+        with self.lock:
+            return [entry['path'] for entry in self.entries.values()]
+    
+    def acquire(self, key):
+        """Pin a song so it isn't evicted while in use"""
+        if key:
+            with self.lock:
+                self.pins[key] = self.pins.get(key, 0) + 1
+    
+    def release(self, key):
+        """Drop a pin taken with acquire"""
+        if not key:
+            return
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+    
+    def pinned(self, key):
+        with self.lock:
+            return key in self.pins
+    
+    def evict(self, keep=None, target=None, min_idle=0):
+        """Remove unpinned songs until the cache fits its byte budget, or target bytes if smaller
+        
+        Songs used in the last min_idle seconds are kept, a download that was
+        just added may not be pinned by the player that wanted it yet.
+        """
+        limit = self.max_bytes if target is None else min(self.max_bytes, target)
+        idle_since = time.time() - min_idle
+        
+        with self.lock:
+            if self.total_bytes <= limit:
+                return
+            
+            if self.policy == 'lfu':
+                rank = lambda key: (self.entries[key]['hits'], self.entries[key]['last_used'])
+            else:
+                rank = lambda key: self.entries[key]['last_used']
+            
+            candidates = sorted(
+                (
+                    key for key in self.entries
+                    if key not in self.pins and key != keep and self.entries[key]['last_used'] <= idle_since
+                ),
+                key=rank
+            )
+            
+            for key in candidates:
+                if self.total_bytes <= limit:
+                    break
+                logger.info(f"Evicting from cache: {key}")
+                self.remove(key)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'songs': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'pinned': len(self.pins),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,732 @@
+import asyncio
+import copy
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from urllib.parse import parse_qs, urlsplit
+
+import yt_dlp
+
+from cogs.audio_cache import AUDIO_CACHE_DIR, cache_key
+from cogs.janitor import job_namespace, remove_namespace
+
+logger = logging.getLogger('Extraction')
+
+# Check if cookies file exists
+COOKIES_FILE = 'cookies.txt'
+HAS_COOKIES = os.path.exists(COOKIES_FILE)
+
+if HAS_COOKIES:
+    logger.info("youtube cookies found - youtube should work")
+else:
+    logger.warning("no cookies.txt found - youtube may be blocked. use soundcloud or add cookies")
+
+# Enhanced yt-dlp options with cookies
+YTDL_OPTIONS = {
+    'format': 'bestaudio/best',
+    'extractaudio': True,
+    'audioformat': 'mp3',
+    'outtmpl': '%(extractor)s-%(id)s.%(ext)s',
+    'paths': {'home': AUDIO_CACHE_DIR},
+    'restrictfilenames': True,
+    # Files keep the time they were written, not the upload time, so the
+    # janitor can tell a fresh download from an orphan
+    'updatetime': False,
+    'noplaylist': False,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'ytsearch',
+    'source_address': '0.0.0.0',
+    'force-ipv4': True,
+    'geo_bypass': True,
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'referer': 'https://www.youtube.com/',
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-us,en;q=0.5',
+        'Sec-Fetch-Mode': 'navigate',
+    },
+    'extractor_retries': 5,
+    'fragment_retries': 5,
+    'skip_unavailable_fragments': True,
+    'keepvideo': False,
+    'postprocessors': [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'opus',
+        'preferredquality': '128',
+    }],
+}
+
+# Add cookies if available
+if HAS_COOKIES:
+    YTDL_OPTIONS['cookiefile'] = COOKIES_FILE
+
+# Threads for searches and metadata, and separately for downloads, so a
+# burst of downloads can't hold up people searching for songs
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+
+# 'thread' runs yt-dlp in the bot process, 'process' hands the work to a
+# pool of worker processes so its CPU-heavy parsing can't hold the GIL
+# while voice and heartbeats need it
+EXTRACTION_BACKEND = os.getenv('EXTRACTION_BACKEND', 'thread').lower()
+EXTRACTION_PROCESSES = int(os.getenv(
+    'EXTRACTION_PROCESSES',
+    str(min(os.cpu_count() or 1, SEARCH_WORKERS + DOWNLOAD_WORKERS))
+))
+
+# Log a warning when a job waits this long for a free thread, in seconds
+EXECUTOR_WAIT_WARNING = float(os.getenv('EXECUTOR_WAIT_WARNING', '1'))
+
+# How long search results and song metadata stay cached, in seconds
+METADATA_CACHE_TTL = int(os.getenv('METADATA_CACHE_TTL', '3600'))
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '2048'))
+
+# How long resolved media urls stay cached; youtube urls also carry their
+# own expiry time, whichever comes first wins
+STREAM_URL_TTL = int(os.getenv('STREAM_URL_TTL', '1800'))
+STREAM_CACHE_SIZE = int(os.getenv('STREAM_CACHE_SIZE', '256'))
+
+# 'hedged' searches youtube and, if it is slow or failing, soundcloud at the
+# same time and takes the first result; 'youtube' only searches youtube
+SEARCH_MODE = os.getenv('SEARCH_MODE', 'hedged').lower()
+
+# Seconds youtube gets to answer on its own before soundcloud is asked too,
+# and the most a search may take in total
+SEARCH_HEDGE_DELAY = float(os.getenv('SEARCH_HEDGE_DELAY', '2'))
+SEARCH_BUDGET = float(os.getenv('SEARCH_BUDGET', '15'))
+
+# Failures in a row before a site is skipped for searches, and for how long
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '3'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '60'))
+
+# Search prefix for each site a search can go to, in order of preference
+SEARCH_PREFIXES = {
+    'youtube': 'ytsearch',
+    'soundcloud': 'scsearch',
+}
+
+# Fields of a yt-dlp result the music commands actually read
+METADATA_FIELDS = (
+    '_type', 'id', 'title', 'duration', 'thumbnail', 'webpage_url', 'url',
+    'extractor', 'extractor_key', 'ie_key', 'http_headers', 'acodec',
+)
+
+YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/)([\w-]{11})')
+
+class TTLCache:
+    """Bounded cache whose entries expire after a time to live
+    
+    The least recently used entry is dropped once the cache is full. Safe to
+    use from executor threads.
+    """
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return None
+            
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+    
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        
+        with self.lock:
+            self.data[key] = (time.monotonic() + ttl, value)
+            self.data.move_to_end(key)
+            
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+# Search results and song info by normalized query or canonical url
+metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+# Full yt-dlp info, including the resolved media url, by canonical url
+stream_cache = TTLCache(STREAM_CACHE_SIZE, STREAM_URL_TTL)
+
+def normalize_query(query):
+    """Normalize a search query so trivially different spellings share a cache entry"""
+    return ' '.join(query.lower().split())
+
+def canonical_url(url):
+    """Reduce a song url to one form per song, dropping tracking parameters"""
+    url = url.strip()
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    
+    if host.startswith('www.'):
+        host = host[4:]
+    if host.startswith('m.'):
+        host = host[2:]
+    
+    if host in ('youtube.com', 'music.youtube.com', 'youtu.be'):
+        query = parse_qs(parts.query)
+        match = YOUTUBE_ID_RE.search(url)
+        playlist = query.get('list', [None])[0]
+        if match and playlist:
+            return f"https://www.youtube.com/watch?v={match.group(1)}&list={playlist}"
+        if match:
+            return f"https://www.youtube.com/watch?v={match.group(1)}"
+        if playlist:
+            return f"https://www.youtube.com/playlist?list={playlist}"
+    
+    if host.endswith('soundcloud.com'):
+        return f"https://soundcloud.com{parts.path.rstrip('/').lower()}"
+    
+    return url
+
+def slim_info(data):
+    """Copy the parts of a yt-dlp result worth caching, dropping format lists"""
+    slim = {key: data[key] for key in METADATA_FIELDS if key in data}
+    
+    if data.get('entries') is not None:
+        slim['entries'] = [slim_info(entry) if entry else None for entry in data['entries']]
+    
+    return slim
+
+def stream_ttl(info):
+    """How long a resolved media url can be cached for"""
+    ttl = STREAM_URL_TTL
+    
+    # Youtube media urls stop working at the time in their expire parameter
+    expire = parse_qs(urlsplit(info.get('url') or '').query).get('expire')
+    if expire:
+        try:
+            ttl = min(ttl, int(expire[0]) - time.time() - 60)
+        except ValueError:
+            pass
+    
+    return ttl
+
+def remember_stream(info):
+    """Cache the full info of a single song so playing it needs no extraction"""
+    if not info or info.get('entries') is not None or not info.get('webpage_url'):
+        return
+    
+    stream_cache.set(canonical_url(info['webpage_url']), info, ttl=stream_ttl(info))
+
+class YoutubeDLPool:
+    """YoutubeDL instances that are built once and reused, one thread at a time
+    
+    Building a YoutubeDL sets up extractors and loads cookies.txt, so the
+    instances are kept around instead of being rebuilt for every request.
+    """
+    
+    def __init__(self, options):
+        self.options = options
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+    
+    def create(self):
+        # Each instance gets its own copy, downloads change their paths
+        ytdl = yt_dlp.YoutubeDL(dict(self.options))
+        # Load cookies.txt now instead of on the first request
+        ytdl.cookiejar
+        with self.lock:
+            self.created += 1
+        return ytdl
+    
+    def warm(self, count):
+        """Build instances ahead of time until the pool holds count of them"""
+        while self.created < count:
+            self.idle.put(self.create())
+    
+    @contextmanager
+    def checkout(self):
+        """Borrow an instance, building a new one if they're all in use"""
+        try:
+            ytdl = self.idle.get_nowait()
+        except queue.Empty:
+            ytdl = self.create()
+        
+        try:
+            yield ytdl
+        finally:
+            self.idle.put(ytdl)
+
+class ExtractionExecutor:
+    """Bounded thread pool that keeps track of its queue depth and wait times"""
+    
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'ytdl-{name}')
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.inflight = {}  # key -> future shared by everyone asking for the same job
+        self.coalesced = 0
+        self.lock = threading.Lock()
+    
+    async def run(self, func, *args):
+        """Run a blocking function on the pool and wait for its result"""
+        submitted = time.perf_counter()
+        
+        def job():
+            wait = time.perf_counter() - submitted
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            
+            if wait > EXECUTOR_WAIT_WARNING:
+                logger.warning(f"{self.name} pool saturated: job waited {wait:.1f}s for a thread")
+            
+            try:
+                return func(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+        
+        def on_done(future):
+            # Jobs cancelled before they started never ran job() to count themselves
+            if future.cancelled():
+                with self.lock:
+                    self.queued -= 1
+        
+        with self.lock:
+            self.queued += 1
+        
+        future = self.executor.submit(job)
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future)
+    
+    async def run_once(self, key, func, *args):
+        """Like run, but callers asking with the same key while it runs share one job
+        
+        A caller that gets cancelled only stops waiting, the job keeps going
+        for everyone else.
+        """
+        future = self.inflight.get(key)
+        
+        if future is None:
+            future = asyncio.ensure_future(self.run(func, *args))
+            self.inflight[key] = future
+            
+            def on_done(done):
+                if self.inflight.get(key) is done:
+                    del self.inflight[key]
+                # The error may have nobody left waiting for it
+                if not done.cancelled():
+                    done.exception()
+            
+            future.add_done_callback(on_done)
+        else:
+            self.coalesced += 1
+        
+        return await asyncio.shield(future)
+    
+    def stats(self):
+        with self.lock:
+            started = self.completed + self.running
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'avg_wait_ms': round(self.total_wait / started * 1000, 1) if started else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+                'inflight': len(self.inflight),
+                'coalesced': self.coalesced,
+            }
+
+# Single songs and searches, and full playlists, need different options
+single_pool = YoutubeDLPool({**YTDL_OPTIONS, 'noplaylist': True})
+playlist_pool = YoutubeDLPool(YTDL_OPTIONS)
+
+search_executor = ExtractionExecutor('search', SEARCH_WORKERS)
+download_executor = ExtractionExecutor('download', DOWNLOAD_WORKERS)
+
+# Worker processes for the process backend, started by warm_pools
+process_pool = None
+
+class ExtractionError(Exception):
+    """yt-dlp failed in a worker process"""
+
+@dataclass
+class ExtractionRequest:
+    """A job for a worker process, made of plain picklable values"""
+    kind: str  # 'extract', 'resolve' or 'download'
+    query: str
+    allow_playlist: bool = False
+    info: dict = None
+
+@dataclass
+class ExtractionResult:
+    """What a worker process sends back, error is set instead of raising"""
+    value: object = None
+    error: str = None
+
+def warm_worker():
+    """Build a worker process's YoutubeDL instances when it starts"""
+    single_pool.warm(1)
+    playlist_pool.warm(1)
+
+def ping():
+    return os.getpid()
+
+def handle_request(request):
+    """Run an ExtractionRequest inside a worker process"""
+    try:
+        if request.kind == 'extract':
+            value = yt_dlp.YoutubeDL.sanitize_info(extract(request.query, request.allow_playlist))
+        elif request.kind == 'resolve':
+            value = yt_dlp.YoutubeDL.sanitize_info(resolve(request.query))
+        elif request.kind == 'download':
+            value = download(request.query, request.info)
+        else:
+            raise ValueError(f"unknown request: {request.kind}")
+    except Exception as e:
+        return ExtractionResult(error=f"{type(e).__name__}: {e}")
+    
+    return ExtractionResult(value=value)
+
+def run_in_worker(request):
+    """Send a request to the process pool and wait for the result (blocking)"""
+    result = process_pool.submit(handle_request, request).result()
+    
+    if result.error:
+        raise ExtractionError(result.error)
+    
+    return result.value
+
+def warm_pools():
+    """Build the YoutubeDL instances or worker processes the executors will need (blocking)"""
+    global process_pool
+    
+    os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+    
+    if EXTRACTION_BACKEND != 'process':
+        single_pool.warm(SEARCH_WORKERS + DOWNLOAD_WORKERS)
+        playlist_pool.warm(1)
+        return
+    
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(
+            max_workers=EXTRACTION_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=warm_worker,
+        )
+    
+    # Submitting a job per worker at once starts every process now rather
+    # than on the first searches
+    pids = {future.result() for future in [process_pool.submit(ping) for _ in range(EXTRACTION_PROCESSES)]}
+    logger.info(f"started {len(pids)} extraction worker processes")
+
+def shutdown_pools():
+    """Stop the worker processes (blocking)"""
+    global process_pool
+    
+    if process_pool is not None:
+        process_pool.shutdown(cancel_futures=True)
+        process_pool = None
+
+def extract(query, allow_playlist=False):
+    """Extract info for a url or search without downloading (blocking)"""
+    if process_pool is not None:
+        return run_in_worker(ExtractionRequest('extract', query, allow_playlist))
+    
+    pool = playlist_pool if allow_playlist else single_pool
+    with pool.checkout() as ytdl:
+        return ytdl.extract_info(query, download=False)
+
+def resolve(url):
+    """Extract the full info of a single song, including its media url (blocking)"""
+    if process_pool is not None:
+        return run_in_worker(ExtractionRequest('resolve', url))
+    
+    data = extract(url)
+    
+    if data and 'entries' in data:
+        data = data['entries'][0]
+    
+    return data
+
+def download(url, info=None):
+    """Download a song, returning its audio file and cache key (blocking)
+    
+    info from an earlier extraction skips extracting the song again, as long
+    as its media urls haven't expired.
+    """
+    if process_pool is not None:
+        return run_in_worker(ExtractionRequest('download', url, info=info))
+    
+    # Partial and intermediate files stay in a directory of this download's
+    # own, yt-dlp moves only the finished file into the cache
+    work_dir = job_namespace('download')
+    
+    with single_pool.checkout() as ytdl:
+        paths = ytdl.params['paths']
+        ytdl.params['paths'] = {**paths, 'temp': work_dir}
+        data = None
+        
+        try:
+            if info:
+                try:
+                    data = ytdl.process_ie_result(copy.deepcopy(info), download=True)
+                except Exception as e:
+                    logger.warning(f"cached info failed to download, extracting again: {e}")
+            
+            if not data:
+                data = ytdl.extract_info(url, download=True)
+        finally:
+            ytdl.params['paths'] = paths
+            remove_namespace(work_dir)
+        
+        if not data:
+            return None, None
+        
+        if 'entries' in data:
+            data = data['entries'][0]
+        
+        filename = ytdl.prepare_filename(data)
+    
+    base_name = os.path.splitext(filename)[0]
+    
+    # The audio postprocessor changes the extension, so look for what it left
+    for ext in ['.opus', '.mp3', '.m4a', '.webm', '.ogg']:
+        potential_file = base_name + ext
+        if os.path.exists(potential_file):
+            return potential_file, cache_key(data)
+    
+    return filename, cache_key(data)
+
+class CircuitBreaker:
+    """Stop sending searches to a site after it fails several times in a row
+    
+    Once open, the site is skipped until the cooldown passes, then a single
+    search is let through to see if it has recovered.
+    """
+    
+    def __init__(self, name, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.trips = 0
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+    
+    def available(self):
+        """Whether allow() would let a search through, without using up the trial"""
+        state = self.state
+        return state == 'closed' or (state == 'half-open' and not self.trial)
+    
+    def allow(self):
+        """Whether a search may be sent to this site now, call it only to send one"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.trial:
+            self.trial = True
+            return True
+        return False
+    
+    def success(self):
+        if self.opened_at is not None:
+            logger.info(f"{self.name} searches are working again")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+    
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            if self.opened_at is None:
+                self.trips += 1
+                logger.warning(f"{self.name} searches failed {self.failures} times, skipping it for {self.cooldown:.0f}s")
+            self.opened_at = time.monotonic()
+    
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+breakers = {name: CircuitBreaker(name) for name in SEARCH_PREFIXES}
+
+async def search_site(site, query, allow_playlist):
+    """Search one site, recording the outcome on its circuit breaker"""
+    breaker = breakers[site]
+    prefix = SEARCH_PREFIXES[site]
+    
+    try:
+        data = await search_executor.run_once(
+            ('search', site, normalize_query(query), allow_playlist),
+            extract, f"{prefix}:{query}", allow_playlist
+        )
+    except asyncio.CancelledError:
+        # Nobody is waiting for the answer, let the next search try again
+        breaker.trial = False
+        raise
+    except Exception as e:
+        breaker.failure()
+        logger.warning(f"{site} search failed: {e}")
+        return None
+    
+    breaker.success()
+    return data if data and data.get('entries') else None
+
+async def search(query, allow_playlist=False, sites=None):
+    """Search for a song, hedging across sites, None if nothing was found in time
+    
+    The first site is asked straight away, and every SEARCH_HEDGE_DELAY
+    seconds without an answer the next one is asked as well. The first
+    search that finds something wins. Sites whose breaker is open are skipped.
+    """
+    if sites is None:
+        sites = list(SEARCH_PREFIXES) if SEARCH_MODE == 'hedged' else ['youtube']
+    
+    sites = [site for site in sites if breakers[site].available()]
+    if not sites:
+        logger.warning(f"every search site is failing, not searching for: {query}")
+        return None
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SEARCH_BUDGET
+    pending = {}  # task -> site
+    
+    try:
+        while sites or pending:
+            if sites:
+                site = sites.pop(0)
+                # Only now, a half-open site's single trial is used up by sending it
+                if breakers[site].allow():
+                    pending[asyncio.ensure_future(search_site(site, query, allow_playlist))] = site
+                if not pending:
+                    continue
+            
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            
+            # Only wait for the hedge delay while there is another site to try
+            timeout = min(SEARCH_HEDGE_DELAY, remaining) if sites else remaining
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            
+            for task in done:
+                pending.pop(task)
+                if task.result():
+                    return task.result()
+        
+        # Sites that couldn't answer within the budget count as failing
+        for site in pending.values():
+            logger.warning(f"{site} search took longer than {SEARCH_BUDGET:.0f}s")
+            breakers[site].failure()
+        return None
+    finally:
+        # The extraction threads keep running and land in the cache, we just
+        # stop waiting for them
+        for task in pending:
+            task.cancel()
+
+def iter_entries(entries):
+    """Iterate playlist entries, whichever lazy container the extractor used"""
+    if isinstance(entries, yt_dlp.utils.PagedList):
+        start = 0
+        while True:
+            page = entries.getslice(start, start + 100)
+            if not page:
+                return
+            yield from page
+            start += len(page)
+    else:
+        yield from entries
+
+class PlaylistReader:
+    """Reads a playlist's entries a page at a time without resolving them
+    
+    Entries come straight from the playlist extractor unprocessed, the same
+    placeholders extract_flat gives, so a playlist can start playing after
+    its first page and is never held in memory all at once. The entries are
+    a live generator tied to this reader's YoutubeDL, so playlists are
+    always read in the bot process, whichever backend is configured.
+    """
+    
+    def __init__(self, url):
+        self.url = url
+        self.ytdl = None
+        self.info = None
+        self.entries = None
+    
+    def open(self):
+        self.ytdl = yt_dlp.YoutubeDL({**YTDL_OPTIONS, 'extract_flat': 'in_playlist'})
+        info = self.ytdl.extract_info(self.url, download=False, process=False)
+        
+        # Follow redirects, like a video url that points at its playlist
+        while info and info.get('_type') in ('url', 'url_transparent'):
+            info = self.ytdl.extract_info(info['url'], download=False, ie_key=info.get('ie_key'), process=False)
+        
+        self.info = info
+        
+        if info and info.get('entries') is not None:
+            self.entries = filter(None, iter_entries(info['entries']))
+        else:
+            self.entries = iter(())
+    
+    def read(self, count):
+        """Get up to count more entries, an empty list once the playlist is done (blocking)"""
+        if self.entries is None:
+            self.open()
+        
+        batch = []
+        for entry in itertools.islice(self.entries, count):
+            slim = slim_info(entry)
+            
+            # Flat entries only list their thumbnails, biggest last
+            if not slim.get('thumbnail') and entry.get('thumbnails'):
+                slim['thumbnail'] = entry['thumbnails'][-1].get('url')
+            
+            batch.append(slim)
+        
+        return batch
+    
+    def close(self):
+        self.ytdl = None
+        self.entries = None
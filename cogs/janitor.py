@@ -0,0 +1,263 @@
+import contextlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from cogs.audio_cache import AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, CACHE_FILE_PATTERN
+
+logger = logging.getLogger('Janitor')
+
+# Every download and recording works in its own directory under here, and
+# only its finished file is moved into the cache
+TMP_DIR = os.path.join(AUDIO_CACHE_DIR, 'tmp')
+
+# Most bytes everything in AUDIO_CACHE_DIR may take, cached songs and work
+# in progress together. Defaults to the cache's budget plus room for downloads
+DISK_QUOTA_BYTES = int(os.getenv('DISK_QUOTA_MB', str(AUDIO_CACHE_MAX_BYTES // (1024 * 1024) + 512))) * 1024 * 1024
+
+# Downloads are refused when the disk has less than this free
+DISK_MIN_FREE_BYTES = int(os.getenv('DISK_MIN_FREE_MB', '256')) * 1024 * 1024
+
+# Room set aside for a download that doesn't report its size
+DOWNLOAD_RESERVE_BYTES = int(os.getenv('DOWNLOAD_RESERVE_MB', '32')) * 1024 * 1024
+
+# Seconds between sweeps for orphaned files
+JANITOR_INTERVAL = float(os.getenv('JANITOR_INTERVAL', '300'))
+
+# Work directories and stray files untouched for this long belong to
+# nothing that is still running, in seconds
+ORPHAN_AGE = 3600
+
+# Songs used this recently are never evicted to make room, in seconds
+EVICT_MIN_IDLE = 60
+
+# AUDIO_CACHE_DIR can point anywhere, so only files named like the cache's
+# own, or yt-dlp's leftovers of them, are ever deleted as orphans
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+# Work directories made by job_namespace
+NAMESPACE_PATTERN = re.compile(r'^[a-z]+-[\w-]+$')
+
+# Work directories of jobs and players still running in this process, never
+# swept however long they go on for
+live_namespaces = set()
+live_lock = threading.Lock()
+
+class DiskQuotaError(Exception):
+    """There is no room for another download"""
+
+def job_namespace(prefix):
+    """Create a fresh work directory for one job (blocking)"""
+    os.makedirs(TMP_DIR, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f"{prefix}-", dir=TMP_DIR)
+    with live_lock:
+        live_namespaces.add(os.path.abspath(path))
+    return path
+
+def player_namespace(guild_id):
+    """A work directory for one music player, whoever writes there first creates it
+    
+    Unique to the player, so tearing down an old player of a guild never
+    touches the recordings of the one that replaced it.
+    """
+    path = os.path.join(TMP_DIR, f"guild-{guild_id}-{uuid.uuid4().hex[:12]}")
+    with live_lock:
+        live_namespaces.add(os.path.abspath(path))
+    return path
+
+def remove_namespace(path):
+    """Delete a work directory and everything left in it (blocking)"""
+    shutil.rmtree(path, ignore_errors=True)
+    with live_lock:
+        live_namespaces.discard(os.path.abspath(path))
+
+def is_cache_file(name):
+    """Whether a file in the cache directory is one the cache could have written"""
+    for suffix in PARTIAL_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return CACHE_FILE_PATTERN.match(name) is not None
+
+def modified(stat):
+    """When a file was last written or moved, even if its mtime was set back"""
+    return max(stat.st_mtime, stat.st_ctime)
+
+def download_size(info):
+    """Bytes to set aside for downloading a song, from the size yt-dlp reports if any"""
+    size = info and (info.get('filesize') or info.get('filesize_approx'))
+    if not size:
+        return DOWNLOAD_RESERVE_BYTES
+    # The download and the audio extracted from it exist together for a moment
+    return int(size) * 2
+
+def tree_size(path):
+    """Bytes taken by the files under a directory (blocking)"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def last_change(path):
+    """When anything under a directory was last written (blocking)
+    
+    A directory's own times only change as files are added or removed, not
+    while one is being written.
+    """
+    latest = modified(os.lstat(path))
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                latest = max(latest, modified(os.lstat(os.path.join(root, name))))
+            except OSError:
+                pass
+    return latest
+
+class Janitor:
+    """Keeps AUDIO_CACHE_DIR under its disk quota and clears out orphans
+    
+    Orphans are work directories and cache files the index doesn't know
+    about, left behind by crashes and killed downloads. At startup nothing
+    is running yet so all of them go, later sweeps only remove those older
+    than ORPHAN_AGE. Every method touches the disk, so run them in an
+    executor.
+    """
+    
+    def __init__(self, cache, quota=DISK_QUOTA_BYTES, min_free=DISK_MIN_FREE_BYTES):
+        self.cache = cache
+        self.quota = quota
+        self.min_free = min_free
+        self.lock = threading.Lock()
+        self.orphans_removed = 0
+        self.bytes_freed = 0
+        self.usage = 0  # Bytes in use at the last check
+        self.reserved = 0  # Bytes set aside for downloads that are running
+    
+    def free_bytes(self):
+        try:
+            return shutil.disk_usage(self.cache.directory).free
+        except OSError:
+            return None
+    
+    @contextlib.contextmanager
+    def reserve(self, size):
+        """Set aside size bytes for a download while it runs
+        
+        Cached songs are evicted to make room, raising DiskQuotaError if
+        there still isn't any. Downloads running at once each hold their own
+        share, so together they can't overshoot the quota.
+        """
+        with self.lock:
+            self.make_room(size)
+            self.reserved += size
+        
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.reserved -= size
+    
+    def make_room(self, size):
+        # Running downloads have written some of what they set aside already
+        work = tree_size(TMP_DIR)
+        pending = max(work, self.reserved)
+        needed = size + pending - work  # Bytes still to be written
+        target = self.quota - pending - size
+        
+        # Other things share the disk, so free up what they took too
+        free = self.free_bytes()
+        if free is not None and free < self.min_free + needed:
+            target = min(target, self.cache.total_bytes - (self.min_free + needed - free))
+        
+        if self.cache.total_bytes > target:
+            self.cache.evict(target=target, min_idle=EVICT_MIN_IDLE)
+        
+        self.usage = self.cache.total_bytes + pending
+        free = self.free_bytes()
+        if self.usage + size > self.quota or (free is not None and free < self.min_free + needed):
+            raise DiskQuotaError(
+                f"disk quota reached: {self.usage // (1024 * 1024)}MB used, "
+                f"{'?' if free is None else free // (1024 * 1024)}MB free"
+            )
+    
+    def sweep(self, startup=False):
+        """Remove orphans and evict down to the quota"""
+        cutoff = time.time() - ORPHAN_AGE
+        removed = freed = 0
+        
+        # Work directories of jobs that are gone. Downloads in worker
+        # processes aren't in live_namespaces, they're kept while written to
+        with live_lock:
+            live = set(live_namespaces)
+        
+        if os.path.isdir(TMP_DIR):
+            for entry in os.scandir(TMP_DIR):
+                if not NAMESPACE_PATTERN.match(entry.name) or os.path.abspath(entry.path) in live:
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if not startup and (
+                        last_change(entry.path) if is_dir else modified(entry.stat(follow_symlinks=False))
+                    ) > cutoff:
+                        continue
+                    if is_dir:
+                        size = tree_size(entry.path)
+                        remove_namespace(entry.path)
+                    else:
+                        size = entry.stat(follow_symlinks=False).st_size
+                        os.remove(entry.path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += size
+        
+        # Files of the cache's own that the index doesn't list
+        known = {os.path.abspath(path) for path in self.cache.paths()}
+        
+        if os.path.isdir(self.cache.directory):
+            for entry in os.scandir(self.cache.directory):
+                if not entry.is_file(follow_symlinks=False) or not is_cache_file(entry.name):
+                    continue
+                if os.path.abspath(entry.path) in known:
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    # A download is moved in just before it is added to the index
+                    if not startup and modified(stat) > cutoff:
+                        continue
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        
+        with self.lock:
+            pending = max(tree_size(TMP_DIR), self.reserved)
+            if self.cache.total_bytes + pending > self.quota:
+                self.cache.evict(target=self.quota - pending, min_idle=EVICT_MIN_IDLE)
+            self.usage = self.cache.total_bytes + pending
+            self.orphans_removed += removed
+            self.bytes_freed += freed
+        
+        if removed:
+            logger.info(f"removed {removed} orphaned files, {freed // (1024 * 1024)}MB")
+        
+        return removed
+    
+    def stats(self):
+        return {
+            'usage': self.usage,
+            'quota': self.quota,
+            'reserved': self.reserved,
+            'orphans_removed': self.orphans_removed,
+            'bytes_freed': self.bytes_freed,
+        }
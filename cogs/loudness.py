@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('Loudness')
+
+# Bring every song to the same loudness with a fixed gain worked out once
+# per song, instead of running a loudnorm filter on every play
+LOUDNESS_NORMALIZE = os.getenv('LOUDNESS_NORMALIZE', 'true').lower() not in ('0', 'false', 'no', 'off')
+
+# Integrated loudness songs are brought to, in LUFS, and the true peak the
+# gain may push them to, in dBTP
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', '-14'))
+LOUDNESS_PEAK_CEILING = -1.0
+
+# Never boost a quiet song by more than this many dB
+LOUDNESS_MAX_BOOST = 12.0
+
+# Songs analyzed at once, each runs its own FFmpeg process
+LOUDNESS_WORKERS = int(os.getenv('LOUDNESS_WORKERS', '1'))
+
+FFMPEG_EXECUTABLE = 'ffmpeg'
+
+def analyze(path):
+    """Measure a file's integrated loudness and true peak with FFmpeg (blocking)
+    
+    Returns {'lufs': ..., 'peak': ...}, or None for silence.
+    """
+    result = subprocess.run(
+        [FFMPEG_EXECUTABLE, '-hide_banner', '-nostats', '-i', path, '-map', '0:a:0',
+         '-af', 'loudnorm=print_format=json', '-f', 'null', '-'],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        check=True
+    )
+    
+    # loudnorm prints its measurements as the last json object on stderr
+    output = result.stderr.decode('utf-8', 'replace')
+    start, end = output.rfind('{'), output.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError('no loudnorm output')
+    stats = json.loads(output[start:end + 1])
+    
+    lufs = float(stats['input_i'])
+    peak = float(stats['input_tp'])
+    if lufs == float('-inf'):
+        return None
+    return {'lufs': round(lufs, 2), 'peak': round(peak, 2)}
+
+def gain_db(loudness):
+    """Static gain bringing a song to LOUDNESS_TARGET without clipping, in dB"""
+    if not LOUDNESS_NORMALIZE or not loudness:
+        return 0.0
+    
+    gain = LOUDNESS_TARGET - loudness['lufs']
+    gain = min(gain, LOUDNESS_PEAK_CEILING - loudness['peak'], LOUDNESS_MAX_BOOST)
+    return round(gain, 2)
+
+class LoudnessAnalyzer:
+    """Analyzes downloaded songs in the background and keeps the results in the audio cache
+    
+    Each song is measured once, results are saved in the cache index with
+    the song's file so they survive restarts.
+    """
+    
+    def __init__(self, cache, workers=LOUDNESS_WORKERS):
+        self.cache = cache
+        self.workers = workers
+        self.executor = None
+        self.pending = set()  # Keys queued or being analyzed
+        self.lock = threading.Lock()
+        self.disabled = not LOUDNESS_NORMALIZE
+        self.analyzed = 0
+        self.failed = 0
+    
+    def submit(self, key):
+        """Queue a cached song for analysis unless it was already measured"""
+        if self.disabled or not key or self.cache.has_loudness(key):
+            return
+        
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='loudness')
+            self.executor.submit(self.run, key)
+    
+    def run(self, key):
+        try:
+            # Stop the cache deleting the file while FFmpeg reads it
+            self.cache.acquire(key)
+            try:
+                path = self.cache.path(key)
+                if path is None:
+                    return
+                loudness = analyze(path)
+            finally:
+                self.cache.release(key)
+            
+            self.cache.set_loudness(key, loudness or {})
+            self.analyzed += 1
+        except FileNotFoundError:
+            logger.warning(f"{FFMPEG_EXECUTABLE} not found, songs won't be normalized")
+            self.disabled = True
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"could not analyze loudness of {key}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+    
+    def shutdown(self):
+        """Drop queued analyses and let running ones finish in the background"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'analyzed': self.analyzed,
+            'failed': self.failed,
+        }
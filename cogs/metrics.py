@@ -0,0 +1,202 @@
+import logging
+import math
+import os
+import time
+
+from aiohttp import web
+from discord.ext import commands
+
+logger = logging.getLogger('Metrics')
+
+# Where the Prometheus metrics endpoint listens, set the port to 0 to turn it off
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Histogram buckets in seconds, from a cache hit to a slow download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric with one value per combination of label values"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.values = {}  # tuple of (label, value) pairs -> value
+        registry.append(self)
+    
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.label_names)
+    
+    def clear(self):
+        self.values.clear()
+    
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, None, value
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(key, extra)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value, **labels):
+        """Set the total directly, for counts kept elsewhere and copied in by a collector"""
+        self.values[self.key(labels)] = value
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+    
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state['counts'][i] += 1
+                break
+        state['sum'] += value
+        state['count'] += 1
+    
+    def samples(self):
+        for key, state in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                total += count
+                yield f"{self.name}_bucket", key, ('le', format_value(bound)), total
+            yield f"{self.name}_sum", key, None, state['sum']
+            yield f"{self.name}_count", key, None, state['count']
+
+registry = []
+collectors = []  # Functions called before every scrape to update gauges
+
+def render():
+    """Everything in the registry in the Prometheus text format"""
+    for collect in list(collectors):
+        try:
+            collect()
+        except Exception as e:
+            logger.error(f"metrics collector failed: {e}")
+    
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class Timer:
+    """Context manager that observes how long its block took on a histogram"""
+    
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+# Playback pipeline
+search_seconds = Histogram('music_search_seconds', 'Time to look up a song or playlist', ['kind'])
+download_seconds = Histogram('music_download_seconds', 'Time to download a song into the cache')
+first_audio_seconds = Histogram(
+    'music_time_to_first_audio_seconds', 'Time from a song being taken off the queue to it starting to play'
+)
+track_gap_seconds = Histogram(
+    'music_track_gap_seconds', 'Silence between one song ending and the next starting', buckets=(
+        0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+    )
+)
+tracks_total = Counter('music_tracks_total', 'Songs started, by how they were played', ['mode'])
+playback_errors_total = Counter('music_playback_errors_total', 'Songs skipped because they failed to play')
+cache_requests_total = Counter('music_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+executor_jobs = Gauge('music_executor_jobs', 'Extraction jobs waiting for or running on a pool', ['pool', 'state'])
+players_active = Gauge('music_players_active', 'Music players that exist')
+# Totals rather than a series per server, which would be thousands of them
+queued_songs = Gauge('music_queued_songs', 'Songs queued across every server')
+queue_songs_max = Gauge('music_queue_songs_max', 'Songs queued on the server with the longest queue')
+
+# Event loop
+loop_lag_seconds = Histogram(
+    'bot_loop_lag_seconds', 'How late the event loop ran a timer', buckets=(
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5
+    )
+)
+loop_stalls_total = Counter('bot_loop_stalls_total', 'Times the event loop was blocked past the lag threshold')
+
+# Commands
+command_seconds = Histogram('bot_command_seconds', 'Time spent running a command', ['command'])
+command_errors_total = Counter('bot_command_errors_total', 'Commands that failed', ['command', 'error'])
+
+class Metrics(commands.Cog):
+    """Serves the metrics over http for Prometheus to scrape"""
+    
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+    
+    async def handle_metrics(self, request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+    
+    async def cog_load(self):
+        if not METRICS_PORT:
+            return
+        
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        
+        try:
+            await web.TCPSite(self.runner, METRICS_HOST, METRICS_PORT).start()
+            logger.info(f"serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(f"could not serve metrics on port {METRICS_PORT}: {e}")
+            await self.runner.cleanup()
+            self.runner = None
+    
+    async def cog_unload(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+async def setup(bot):
+    await bot.add_cog(Metrics(bot))
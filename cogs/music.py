@@ -1,175 +1,891 @@
 import discord
 from discord.ext import commands
+import array
 import asyncio
-import yt_dlp
-from collections import deque
 import logging
-import functools
+import itertools
 import os
+import shlex
+import sys
+from collections import deque
 
-logger = logging.getLogger('MusicCog')
-
-# Check if cookies file exists
-COOKIES_FILE = 'cookies.txt'
-HAS_COOKIES = os.path.exists(COOKIES_FILE)
-
-if HAS_COOKIES:
-    logger.info("youtube cookies found - youtube should work")
-else:
-    logger.warning("no cookies.txt found - youtube may be blocked. use soundcloud or add cookies")
-
-# Enhanced yt-dlp options with cookies
-YTDL_OPTIONS = {
-    'format': 'bestaudio/best',
-    'extractaudio': True,
-    'audioformat': 'mp3',
-    'outtmpl': 'downloads/%(extractor)s-%(id)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': False,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'ytsearch',
-    'source_address': '0.0.0.0',
-    'force-ipv4': True,
-    'geo_bypass': True,
-    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-    'referer': 'https://www.youtube.com/',
-    'http_headers': {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-us,en;q=0.5',
-        'Sec-Fetch-Mode': 'navigate',
-    },
-    'extractor_retries': 5,
-    'fragment_retries': 5,
-    'skip_unavailable_fragments': True,
-    'keepvideo': False,
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'opus',
-        'preferredquality': '128',
-    }],
-}
+from cogs.audio_cache import AudioCache, cache_key
+from cogs.extraction import (
+    HAS_COOKIES, PlaylistReader, breakers, canonical_url, download, download_executor, extract,
+    metadata_cache, normalize_query, remember_stream, resolve, search, search_executor,
+    shutdown_pools, slim_info, stream_cache, warm_pools
+)
+from cogs.janitor import (
+    JANITOR_INTERVAL, DiskQuotaError, Janitor, download_size, player_namespace, remove_namespace
+)
+from cogs.loudness import LoudnessAnalyzer, gain_db
+from cogs.metrics import (
+    Timer, cache_requests_total, collectors, download_seconds, executor_jobs, first_audio_seconds,
+    playback_errors_total, players_active, queue_songs_max, queued_songs, search_seconds, track_gap_seconds,
+    tracks_total
+)
+from cogs.music_queue import SongQueue
+from cogs.opus_store import OpusStoreError, OpusStoreSource, OpusStoreWriter, store_key
+from cogs.tracing import span
 
-# Add cookies if available
-if HAS_COOKIES:
-    YTDL_OPTIONS['cookiefile'] = COOKIES_FILE
+logger = logging.getLogger('MusicCog')
 
 # Simple FFmpeg options
 FFMPEG_OPTIONS = {
     'options': '-vn'
 }
 
-def get_ytdl():
-    """Get a fresh YTDL instance"""
-    os.makedirs('downloads', exist_ok=True)
-    return yt_dlp.YoutubeDL(YTDL_OPTIONS)
+# FFmpeg options for playing a remote stream: reconnect on dropped
+# connections instead of ending the song early
+FFMPEG_STREAM_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -rw_timeout 15000000'
+
+# Hand opus audio to discord as-is instead of decoding it to PCM and
+# encoding it again in the bot process
+OPUS_PASSTHROUGH = os.getenv('OPUS_PASSTHROUGH', 'true').lower() not in ('0', 'false', 'no', 'off')
+
+# Keep the opus frames of songs that played to the end in the audio cache,
+# so replays are read straight from disk without starting FFmpeg
+OPUS_STORE = os.getenv('OPUS_STORE', 'true').lower() not in ('0', 'false', 'no', 'off')
+
+# A recording this many frames short of the song's duration was cut off
+STORE_TOLERANCE_FRAMES = 50
+
+# Open and pre-buffer the next song's audio while the current one is still
+# playing, so FFmpeg starting up isn't heard as silence between songs
+GAPLESS = os.getenv('GAPLESS', 'true').lower() not in ('0', 'false', 'no', 'off')
+
+# Seconds before the end of a song that the next one is opened
+GAPLESS_LEAD_SECONDS = float(os.getenv('GAPLESS_LEAD_SECONDS', '5'))
+
+# 20ms frames read from the next song's FFmpeg before it starts playing
+PREBUFFER_FRAMES = 25
+
+# Seconds songs fade into each other, 0 for none. Fading mixes PCM in the
+# bot process, so it turns opus passthrough off
+CROSSFADE_SECONDS = float(os.getenv('CROSSFADE_SECONDS', '0'))
+CROSSFADE_FRAMES = int(CROSSFADE_SECONDS * 50)
+
+# 'download' saves songs to disk before playing, 'stream' plays the media
+# url directly and only downloads when streaming fails
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'download').lower()
+
+# How many upcoming songs to download while the current one plays (0 disables)
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', '2'))
+
+# Seconds a player can sit with nothing playing or queued before it is
+# torn down and its voice connection closed
+PLAYER_IDLE_TIMEOUT = int(os.getenv('PLAYER_IDLE_TIMEOUT', '300'))
+
+# Playlists are read and queued this many entries at a time
+PLAYLIST_BATCH_SIZE = 50
+
+# Most songs a single playlist can add to the queue
+MAX_PLAYLIST_SIZE = int(os.getenv('MAX_PLAYLIST_SIZE', '5000'))
+
+# Volume of servers that haven't picked one with !volume, and the most
+# they can pick, in percent
+DEFAULT_VOLUME = int(os.getenv('DEFAULT_VOLUME', '100'))
+MAX_VOLUME = 200
+
+# Gains closer to 1 than this are left out, so the song can skip FFmpeg's
+# volume filter and keep playing its opus untouched. Volumes this close to
+# 100% also keep replaying stored frames
+GAIN_TOLERANCE = 0.06
+
+# Songs shown per page of !queue, and how long its buttons keep working
+QUEUE_PAGE_SIZE = 10
+QUEUE_VIEW_TIMEOUT = 180
+
+# Downloaded songs shared by every guild, kept between plays and restarts
+audio_cache = AudioCache()
+
+# Measures how loud downloaded songs are, once each, in the background
+loudness_analyzer = LoudnessAnalyzer(audio_cache)
+
+# Keeps the cache directory under its disk quota and free of orphans
+janitor = Janitor(audio_cache)
+
+def download_audio(url, info=None):
+    """Download a song into the audio cache, returning its file and cache key (blocking)"""
+    # Held until the file is counted in the cache
+    with janitor.reserve(download_size(info)):
+        audio_file, key = download(url, info)
+        audio_cache.add(key, audio_file)
+    loudness_analyzer.submit(key)
+    return audio_file, key
+
+def save_store(writer, key, replaces=()):
+    """Move a finished recording into the audio cache as a frame store (blocking)
+    
+    Stores of the same song recorded at a gain it no longer plays at are
+    listed in replaces and deleted, unless a player is still using them.
+    """
+    path = os.path.join(audio_cache.directory, key)
+    try:
+        writer.finish(path)
+    except OSError as e:
+        logger.error(f"could not save frame store {key}: {e}")
+        writer.discard()
+        return
+    audio_cache.add(key, path)
+    
+    for old in replaces:
+        if not audio_cache.pinned(old):
+            audio_cache.remove(old)
+
+def source_name(url):
+    """Name the site a song url belongs to"""
+    url = (url or '').lower()
+    if 'soundcloud' in url:
+        return 'soundcloud'
+    elif 'youtube' in url or 'youtu.be' in url:
+        return 'youtube'
+    return 'audio'
+
+def stream_ffmpeg_options(headers):
+    """Build FFmpeg options for streaming a url with the given headers"""
+    before_options = FFMPEG_STREAM_BEFORE_OPTIONS
+    
+    if headers:
+        header_lines = ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+        before_options += f' -headers {shlex.quote(header_lines)}'
+    
+    return {'before_options': before_options, **FFMPEG_OPTIONS}
+
+def file_codec(audio_file):
+    """Guess the codec of a file from its extension, None if it needs probing"""
+    # The FFmpegExtractAudio postprocessor always writes opus into .opus files
+    if audio_file.endswith('.opus'):
+        return 'opus'
+    return None
+
+def parse_position(text):
+    """Seconds from a position like 90, 1:30 or 1:02:03, None if it isn't one"""
+    try:
+        parts = [float(part) for part in text.split(':')]
+    except ValueError:
+        return None
+    
+    if not 1 <= len(parts) <= 3 or any(part < 0 for part in parts):
+        return None
+    
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+def format_position(seconds):
+    """Format seconds as m:ss, or h:mm:ss for an hour or more"""
+    hours, rest = divmod(int(seconds), 3600)
+    mins, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{mins:02d}:{secs:02d}"
+    return f"{mins}:{secs:02d}"
+
+def crossfade(outgoing, incoming, weight):
+    """Mix two frames of 16-bit PCM, weighting the outgoing one from 1 down to 0"""
+    a = array.array('h', outgoing)
+    b = array.array('h', incoming)
+    
+    # The last frame of a song can be short
+    if len(a) < len(b):
+        a.extend(itertools.repeat(0, len(b) - len(a)))
+    elif len(b) < len(a):
+        b.extend(itertools.repeat(0, len(a) - len(b)))
+    
+    other = 1 - weight
+    return array.array('h', [int(x * weight + y * other) for x, y in zip(a, b)]).tobytes()
+
+class TrackedAudio(discord.AudioSource):
+    """Wraps an audio source to count the frames sent to discord
+    
+    Frames can be read ahead with fill() before the source is played, and a
+    PCM source can fade into the next song's source over its last frames.
+    A source opened part way into a song counts from start_frame.
+    """
+    
+    def __init__(self, source, mode='pcm', total_frames=None, start_frame=0):
+        self.source = source
+        self.mode = mode
+        self.frames = 0
+        self.start_frame = start_frame
+        self.total_frames = total_frames  # Expected length, from the song's duration
+        self.buffered = deque()  # Frames read ahead by fill()
+        self.on_start = None  # Called from the audio thread when the first frame is sent
+        self.fade_into = None  # Next song's source, mixed in over the last CROSSFADE_FRAMES
+        self.recorder = None  # Writes the frames sent into a frame store
+        self.store_key = None
+        self.replaces = ()  # Stores the recording makes stale
+        self.finished = False  # The source ran out rather than being stopped
+    
+    @property
+    def position(self):
+        """Seconds into the song of the last frame sent"""
+        return (self.start_frame + self.frames) * 0.02
+    
+    def record(self, writer, key, replaces=()):
+        """Save the frames as they are sent, kept under key if the song plays to its end"""
+        self.recorder = writer
+        self.store_key = key
+        self.replaces = replaces
+    
+    def fill(self, count):
+        """Read up to count frames ahead, blocking until FFmpeg produces them"""
+        while len(self.buffered) < count:
+            data = self.source.read()
+            if not data:
+                break
+            self.buffered.append(data)
+    
+    def read(self):
+        data = self.buffered.popleft() if self.buffered else self.source.read()
+        if not data:
+            self.finished = True
+            return data
+        
+        if self.recorder is not None:
+            try:
+                self.recorder.write(data)
+            except OSError as e:
+                logger.warning(f"stopped recording frames for {self.store_key}: {e}")
+                self.recorder.discard()
+                self.recorder = None
+        
+        self.frames += 1
+        if self.frames == 1 and self.on_start:
+            self.on_start()
+        
+        following = self.fade_into
+        if following is not None and self.total_frames:
+            remaining = self.total_frames - self.start_frame - self.frames
+            if remaining < CROSSFADE_FRAMES:
+                data = crossfade(data, following.read(), max(0, remaining) / CROSSFADE_FRAMES)
+        
+        return data
+    
+    def is_opus(self):
+        return self.source.is_opus()
+    
+    def cleanup(self):
+        self.source.cleanup()
+        
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return
+        
+        if self.finished and self.total_frames and self.frames >= self.total_frames - STORE_TOLERANCE_FRAMES:
+            save_store(recorder, self.store_key, self.replaces)
+        else:
+            recorder.discard()
 
 class Song:
-    def __init__(self, url, title, duration, thumbnail, requester, source='Unknown', filepath=None):
+    """A queued track
+    
+    Slotted and holding only the requester's id, since loop queues of long
+    playlists keep a lot of these alive. The Member is looked up when needed.
+    """
+    
+    __slots__ = (
+        'url', 'title', 'duration', 'thumbnail', 'requester_id', 'source', 'filepath', 'cache_key',
+        'resolved', 'stream_url', 'http_headers', 'stream_codec', 'stream_failed', 'store_path'
+    )
+    
+    def __init__(self, url, title, duration, thumbnail, requester_id, source='Unknown', filepath=None, cache_key=None,
+                 resolved=True):
         self.url = url
         self.title = title
         self.duration = duration
         self.thumbnail = thumbnail
-        self.requester = requester
-        self.source = source
+        self.requester_id = requester_id
+        self.source = sys.intern(source)  # Only a handful of distinct values
         self.filepath = filepath
+        self.cache_key = cache_key
+        self.resolved = resolved  # False for playlist entries still missing their details
+        self.stream_url = None
+        self.http_headers = None
+        self.stream_codec = None
+        self.stream_failed = False
+        self.store_path = None  # Frame store of the song, played instead of its file
+    
+    def requester(self, guild):
+        """The member who queued the song, None if they left the server"""
+        return guild.get_member(self.requester_id)
+    
+    def requester_mention(self, guild):
+        member = self.requester(guild)
+        return member.mention if member else f"<@{self.requester_id}>"
 
 class MusicPlayer:
-    def __init__(self, ctx):
+    def __init__(self, ctx, on_idle, streaming=False, volume=DEFAULT_VOLUME):
         self.bot = ctx.bot
         self.guild = ctx.guild
         self.text_channel = ctx.channel
-        self.queue = deque()
+        self.queue = SongQueue()
         self.current = None
         self.voice_client = None
         self.next_event = asyncio.Event()
+        self.prefetch_tasks = {}  # Song -> task preparing it ahead of time
+        self.pinned = {}  # Song -> frame store key, for songs whose cached files this player is holding
+        self.queue_pages = {}  # page -> rendered song list, valid for queue_pages_version
+        self.queue_pages_version = None
+        self.queue_view = None  # Last !queue message, edited instead of sending another
+        self.playlist_tasks = set()  # Playlists still being loaded into the queue
+        self.streaming = streaming
+        self.volume = volume  # Percent, applied by FFmpeg on top of the song's loudness gain
+        self.on_idle = on_idle  # Called with the player once it has been idle too long
+        self.last_active = self.bot.loop.time()
+        self.song_ended = None  # When the last song stopped, to measure the gap before the next
+        self.source = None  # Audio source of the song playing now
+        self.preload_task = None  # Opens the next song's source near the end of this one
+        self.preloaded = None  # (song, source) opened ahead of time by preload()
+        self.namespace = player_namespace(self.guild.id)  # Where this player's recordings are written
         
         # Loop settings
         self.loop_song = False  # Loop current song
         self.loop_queue = False  # Loop entire queue
         
-        self.bot.loop.create_task(self.player_loop())
+        self.task = self.bot.loop.create_task(self.player_loop())
+    
+    def touch(self):
+        """Mark the player as in use, pushing back its idle timeout"""
+        self.last_active = self.bot.loop.time()
+    
+    def clear(self):
+        """Empty the queue and stop everything preparing songs for it"""
+        self.queue.clear()
+        self.cancel_prefetch()
+        self.drop_preload()
+        for task in list(self.playlist_tasks):
+            task.cancel()
+    
+    def queue_page(self, page):
+        """Render one page of upcoming songs, reusing it until the queue changes"""
+        if self.queue_pages_version != self.queue.version:
+            self.queue_pages = {}
+            self.queue_pages_version = self.queue.version
+        
+        if page not in self.queue_pages:
+            start = page * QUEUE_PAGE_SIZE
+            songs = self.queue.islice(start, start + QUEUE_PAGE_SIZE)
+            self.queue_pages[page] = "\n".join(
+                f"`{i}.` {song.title[:80]}" for i, song in enumerate(songs, start + 1)
+            )
+        
+        return self.queue_pages[page]
+    
+    async def destroy(self):
+        """Stop the player's tasks, release its cached files and leave voice"""
+        self.clear()
+        if self.queue_view:
+            self.queue_view.stop()
+        self.loop_song = False
+        self.loop_queue = False
+        
+        for song in list(self.pinned):
+            self.unpin(song)
+        
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        
+        if self.voice_client and self.voice_client.is_connected():
+            self.voice_client.stop()
+            await self.voice_client.disconnect()
+        
+        self.voice_client = None
+        self.current = None
+        
+        # Only this player's unfinished recordings, other players keep theirs
+        await self.bot.loop.run_in_executor(None, remove_namespace, self.namespace)
+    
+    async def wait_for_songs(self):
+        """Wait for a song to be queued, False if the player went idle for too long"""
+        while not self.queue:
+            remaining = self.last_active + PLAYER_IDLE_TIMEOUT - self.bot.loop.time()
+            if remaining <= 0:
+                return False
+            
+            try:
+                await asyncio.wait_for(self.queue.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        
+        return True
+    
+    async def prepare(self, song):
+        """Make a song playable, returning False if it can't be"""
+        # Songs played to the end before replay their stored frames, and
+        # cached songs play from disk, without asking yt-dlp anything
+        if OPUS_STORE and not CROSSFADE_FRAMES and self.unity_volume():
+            song.store_path = audio_cache.get(self.store_key(song))
+            if song.store_path:
+                self.pin(song)
+                return True
+        
+        cached_file = audio_cache.get(song.cache_key)
+        if cached_file:
+            song.filepath = cached_file
+            self.pin(song)
+            # Songs cached before loudness was analyzed get measured now
+            loudness_analyzer.submit(song.cache_key)
+            return True
+        
+        if song.filepath and os.path.exists(song.filepath):
+            return True
+        
+        if not song.resolved:
+            await self.resolve(song)
+        
+        if self.streaming and not song.stream_failed:
+            info = stream_cache.get(canonical_url(song.url))
+            
+            try:
+                if info is None:
+                    info = await search_executor.run_once(('resolve', canonical_url(song.url)), resolve, song.url)
+                    remember_stream(info)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"could not resolve stream for {song.title}: {e}")
+            
+            if info:
+                song.stream_url = info.get('url')
+                song.http_headers = info.get('http_headers')
+                song.stream_codec = info.get('acodec')
+            
+            if song.stream_url:
+                return True
+            
+            logger.info(f"Streaming unavailable, downloading: {song.title}")
+        
+        return bool(await self.download(song))
+    
+    async def resolve(self, song):
+        """Fill in the details a playlist entry was queued without"""
+        info = stream_cache.get(canonical_url(song.url))
+        
+        if info is None:
+            info = await search_executor.run_once(('resolve', canonical_url(song.url)), resolve, song.url)
+            remember_stream(info)
+        
+        if info:
+            song.url = info.get('webpage_url') or song.url
+            song.title = info.get('title') or song.title
+            song.duration = info.get('duration') or song.duration
+            song.thumbnail = info.get('thumbnail') or song.thumbnail
+            song.cache_key = song.cache_key or cache_key(info)
+        
+        song.resolved = True
+    
+    async def download(self, song):
+        """Download a song into the cache"""
+        logger.info(f"Downloading: {song.title}")
+        
+        # Reuse the info from when the song was searched instead of extracting
+        # it again, as long as its media urls haven't expired
+        info = stream_cache.get(canonical_url(song.url))
+        
+        # A cancelled prefetch stops waiting here, the download thread still
+        # finishes and leaves the song in the cache for next time. Players
+        # downloading the same song at once share a single download and each
+        # pin the file it produces
+        job = song.cache_key or canonical_url(song.url)
+        with Timer(download_seconds):
+            song.filepath, key = await download_executor.run_once(job, download_audio, song.url, info)
+        song.cache_key = song.cache_key or key
+        self.pin(song)
+        
+        return song.filepath
+    
+    def pin(self, song):
+        """Keep a song's cached file from being evicted while this player needs it"""
+        if song.cache_key and song not in self.pinned:
+            key = self.store_key(song)
+            audio_cache.acquire(song.cache_key)
+            audio_cache.acquire(key)
+            self.pinned[song] = key
+    
+    def unpin(self, song):
+        """Let the cache evict a song's file again"""
+        if song in self.pinned:
+            audio_cache.release(song.cache_key)
+            audio_cache.release(self.pinned.pop(song))
+    
+    def normalization(self, song):
+        """A song's loudness correction in dB, 0 if it's too small to filter for"""
+        gain = gain_db(audio_cache.loudness(song.cache_key)) if song.cache_key else 0.0
+        gain = round(gain, 1)
+        return gain if abs(10 ** (gain / 20) - 1) >= GAIN_TOLERANCE else 0.0
+    
+    def store_key(self, song):
+        """Cache key of the frame store a song replays from, recorded with its loudness correction"""
+        return store_key(song.cache_key, self.normalization(song))
+    
+    def unity_volume(self):
+        return abs(self.volume / 100 - 1) < GAIN_TOLERANCE
+    
+    def playback_gain(self, song):
+        """Linear gain for a song, its loudness correction times the server's volume"""
+        gain = 10 ** (self.normalization(song) / 20)
+        if not self.unity_volume():
+            gain *= self.volume / 100
+        return gain
+    
+    async def create_source(self, song, start=0):
+        """Open an audio source for a prepared song, None if it has nothing to play
+        
+        start is how many seconds into the song to begin. Files and streams
+        are seeked by FFmpeg on the input side, which jumps straight there
+        instead of decoding everything before it.
+        
+        Frame stores are recorded with the song's loudness correction, so
+        they replay untouched at any volume close to 100%. Other volumes play
+        the file through FFmpeg instead, unless the store is all there is.
+        """
+        total_frames = int(song.duration * 50) if song.duration else None
+        start_frame = round(start * 50)
+        gain = self.playback_gain(song)
+        unity = abs(gain - 1) < GAIN_TOLERANCE
+        key = self.store_key(song)
+        
+        # The song's loudness may have been measured since it was prepared,
+        # which makes its store one recorded at another gain
+        stored = None
+        if OPUS_STORE and not CROSSFADE_FRAMES and self.unity_volume():
+            stored = song.store_path if song.store_path == audio_cache.path(key) else audio_cache.get(key)
+        
+        if song.store_path and not stored and not song.filepath:
+            song.filepath = audio_cache.get(song.cache_key)
+        
+        path = stored or song.store_path
+        if stored or (path and not (song.filepath or song.stream_url)):
+            try:
+                source = OpusStoreSource(path, start_frame)
+                song.store_path = path
+                return TrackedAudio(source, 'stored', total_frames, start_frame)
+            except (OSError, ValueError, OpusStoreError) as e:
+                logger.warning(f"dropping unreadable frame store {path}: {e}")
+                # Stores are saved under their cache key
+                audio_cache.remove(os.path.basename(path))
+                song.store_path = None
+        
+        if song.filepath and os.path.exists(song.filepath):
+            target, options = song.filepath, FFMPEG_OPTIONS
+            codec = file_codec(song.filepath)
+        elif song.stream_url:
+            target, options = song.stream_url, stream_ffmpeg_options(song.http_headers)
+            codec = song.stream_codec
+        else:
+            return None
+        
+        if start_frame:
+            before_options = f"-ss {start_frame * 0.02:.2f} {options.get('before_options', '')}"
+            options = {**options, 'before_options': before_options.strip()}
+        
+        # A static volume filter in FFmpeg, instead of scaling every frame in
+        # python with PCMVolumeTransformer
+        if not unity:
+            options = {**options, 'options': f"{options['options']} -af volume={gain:.3f}"}
+        
+        if not OPUS_PASSTHROUGH or CROSSFADE_FRAMES:
+            return TrackedAudio(discord.FFmpegPCMAudio(target, **options), 'pcm', total_frames, start_frame)
+        
+        # Filtered audio has to be encoded again, so there's no codec to find out
+        if not unity:
+            codec = None
+        elif not codec or codec == 'none':
+            codec, _ = await discord.FFmpegOpusAudio.probe(target, method='fallback')
+        
+        # FFmpeg copies opus packets straight through and encodes anything
+        # else itself, so the bot process never touches PCM
+        source = discord.FFmpegOpusAudio(target, codec=codec, **options)
+        mode = 'passthrough' if codec in ('opus', 'libopus') else 'transcode'
+        source = TrackedAudio(source, mode, total_frames, start_frame)
+        
+        # Record the frames on this play so the next one needs no FFmpeg,
+        # loudness correction included. Without a duration there is no telling
+        # if the song played to its end, and streams stay off the disk
+        if (OPUS_STORE and self.unity_volume() and song.cache_key and total_frames and not start_frame
+                and target == song.filepath):
+            writer = OpusStoreWriter(self.namespace, song.cache_key)
+            # A store recorded before the song's loudness was measured
+            uncorrected = store_key(song.cache_key)
+            source.record(writer, key, (uncorrected,) if uncorrected != key else ())
+        
+        return source
+    
+    async def seek(self, position):
+        """Restart the playing song position seconds in, False if it can't be
+        
+        The new source replaces the old one inside the voice client, so the
+        song isn't stopped and player_loop carries on as if nothing happened.
+        """
+        old = self.source
+        
+        def playing():
+            return (
+                self.source is old and self.voice_client is not None
+                and (self.voice_client.is_playing() or self.voice_client.is_paused())
+            )
+        
+        if old is None or not playing():
+            return False
+        
+        source = await self.create_source(self.current, start=position)
+        if source is None:
+            return False
+        
+        # The song could have ended while FFmpeg was starting
+        if not playing():
+            source.cleanup()
+            return False
+        
+        paused = self.voice_client.is_paused()
+        source.fade_into = old.fade_into
+        self.source = source
+        self.voice_client.source = source
+        if paused:
+            self.voice_client.pause()
+        
+        # The audio thread may still be reading its last frame from the old
+        # source, and closing FFmpeg waits for the process to exit
+        self.bot.loop.call_later(0.1, self.bot.loop.run_in_executor, None, old.cleanup)
+        
+        # Opening the next song is timed from the position, so start over
+        if self.preload_task and not self.preload_task.done():
+            self.preload_task.cancel()
+            self.preload_task = self.bot.loop.create_task(self.preload(source))
+        
+        return True
+    
+    async def set_volume(self, volume):
+        """Change the volume, restarting the playing song where it is so it's heard now"""
+        self.volume = volume
+        
+        source = self.source
+        if source is None or not self.voice_client or not (
+            self.voice_client.is_playing() or self.voice_client.is_paused()
+        ):
+            return
+        
+        # The next song was opened at the old volume
+        self.drop_preload()
+        await self.seek(source.position)
+        
+        if GAPLESS and self.preload_task is None:
+            self.preload_task = self.bot.loop.create_task(self.preload(self.source))
+    
+    async def preload(self, source):
+        """Open and pre-buffer the next song's source while source is playing
+        
+        Waits until the current song is GAPLESS_LEAD_SECONDS from its end, so
+        a stream isn't held open for the whole song, then leaves the next
+        song's source in self.preloaded for player_loop to start right away.
+        """
+        if not self.current.duration:
+            # No telling when it ends, and live streams never do
+            return
+        
+        # Counted in frames sent so time spent paused doesn't count
+        while True:
+            remaining = self.current.duration - source.position - GAPLESS_LEAD_SECONDS
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        
+        if self.loop_song:
+            song = self.current
+        elif self.queue:
+            song = self.queue[0]
+        else:
+            return
+        
+        task = self.prefetch_tasks.get(song)
+        if task is None and song is not self.current:
+            return
+        
+        # Shielded so a cancelled preload leaves the prefetch running. If it
+        # failed, player_loop reports that once it gets to the song
+        try:
+            if task and not await asyncio.shield(task):
+                return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return
+        
+        following = await self.create_source(song)
+        if following is None:
+            return
+        
+        try:
+            await self.bot.loop.run_in_executor(None, following.fill, PREBUFFER_FRAMES)
+        except BaseException:
+            self.bot.loop.run_in_executor(None, following.cleanup)
+            raise
+        
+        self.preloaded = (song, following)
+        if CROSSFADE_FRAMES and source is self.source:
+            source.fade_into = following
+    
+    def take_preloaded(self, song):
+        """The source preloaded for song, closing it if another song is up instead"""
+        if self.preload_task and not self.preload_task.done():
+            self.preload_task.cancel()
+        self.preload_task = None
+        
+        preloaded, self.preloaded = self.preloaded, None
+        if preloaded is None:
+            return None
+        
+        preloaded_song, source = preloaded
+        if preloaded_song is song:
+            return source
+        
+        # Closing FFmpeg waits for the process to exit, and a finished
+        # recording is saved into the cache, so keep both off the loop
+        self.bot.loop.run_in_executor(None, source.cleanup)
+        return None
+    
+    def drop_preload(self):
+        """Close the next song's source if it was opened ahead of time"""
+        if self.source:
+            self.source.fade_into = None
+        self.take_preloaded(None)
+    
+    def audio_started(self, started, ended, now):
+        """Record how long the song took to be heard, called once its first frame is sent"""
+        first_audio_seconds.observe(now - started)
+        if ended is not None:
+            track_gap_seconds.observe(max(0.0, now - ended))
+    
+    def prefetch(self):
+        """Prepare the next PREFETCH_DEPTH songs in the background"""
+        upcoming = [
+            song for song in itertools.islice(self.queue, PREFETCH_DEPTH)
+            if song is not self.current
+        ]
+        
+        # Drop prefetches for songs that are no longer coming up next
+        for song in list(self.prefetch_tasks):
+            if not any(song is s for s in upcoming):
+                self.drop_prefetch(song)
+        
+        for song in upcoming:
+            if song not in self.prefetch_tasks:
+                self.prefetch_tasks[song] = self.bot.loop.create_task(self.prepare(song))
+    
+    def drop_prefetch(self, song):
+        """Cancel preparing a song that isn't coming up next anymore"""
+        task = self.prefetch_tasks.pop(song)
+        task.cancel()
+        
+        # Nobody will await a prefetch that already failed, so collect its error
+        if task.done() and not task.cancelled():
+            task.exception()
+        
+        self.unpin(song)
+    
+    def cancel_prefetch(self):
+        """Cancel all background preparation"""
+        for song in list(self.prefetch_tasks):
+            self.drop_prefetch(song)
     
     async def player_loop(self):
         await self.bot.wait_until_ready()
         
         while not self.bot.is_closed():
             self.next_event.clear()
+            self.touch()
+            
+            # Let the cache evict the last song unless it's about to play again
+            if self.current and not self.loop_song:
+                self.unpin(self.current)
             
             # If looping song and we have a current song, re-add it
             if self.loop_song and self.current:
                 self.queue.appendleft(self.current)
             
             if not self.queue:
-                await asyncio.sleep(1)
+                # Time spent waiting for someone to queue a song isn't a gap
+                self.song_ended = None
+                
+                # Sleeps until a song is queued instead of polling
+                if not await self.wait_for_songs():
+                    logger.info(f"player in {self.guild.name} went idle, shutting it down")
+                    self.on_idle(self)
+                    return
                 continue
             
             try:
                 self.current = self.queue.popleft()
+                started = self.bot.loop.time()
                 
                 # If loop queue is enabled, add song back to end of queue
                 if self.loop_queue:
                     self.queue.append(self.current)
                 
-                loop = self.bot.loop or asyncio.get_event_loop()
+                # Take over the prefetch for this song if there is one
+                # before topping up the lookahead window behind it
+                task = self.prefetch_tasks.pop(self.current, None)
+                self.prefetch()
                 
-                ytdl = get_ytdl()
-                
-                logger.info(f"Downloading: {self.current.title}")
-                
-                data = await loop.run_in_executor(
-                    None,
-                    functools.partial(ytdl.extract_info, self.current.url, download=True)
-                )
+                if task:
+                    ready = await task
+                else:
+                    ready = await self.prepare(self.current)
                 
-                if not data:
+                if not ready:
+                    playback_errors_total.inc()
                     await self.text_channel.send(f"could not download: {self.current.title}")
                     continue
                 
-                if 'entries' in data:
-                    data = data['entries'][0]
-                
-                filename = ytdl.prepare_filename(data)
-                
-                audio_file = None
-                base_name = os.path.splitext(filename)[0]
-                
-                for ext in ['.opus', '.mp3', '.m4a', '.webm', '.ogg']:
-                    potential_file = base_name + ext
-                    if os.path.exists(potential_file):
-                        audio_file = potential_file
-                        break
+                audio_file = self.current.filepath
+                if audio_file and not os.path.exists(audio_file):
+                    audio_file = None
                 
-                if not audio_file:
-                    audio_file = filename
+                # Picking up the preloaded source here, with nothing awaited
+                # since the last song ended, is what makes the change gapless
+                source = self.take_preloaded(self.current)
+                if source is None:
+                    source = await self.create_source(self.current)
                 
-                if not os.path.exists(audio_file):
-                    logger.error(f"audio file not found: {audio_file}")
+                if source is None:
+                    playback_errors_total.inc()
+                    logger.error(f"audio file not found: {self.current.filepath}")
                     await self.text_channel.send(f"could not find audio file for: {self.current.title}")
                     continue
                 
-                logger.info(f"Playing file: {audio_file}")
-                
-                source = discord.FFmpegPCMAudio(audio_file, **FFMPEG_OPTIONS)
+                if self.current.store_path:
+                    logger.info(f"Playing stored frames: {self.current.store_path}")
+                elif audio_file:
+                    logger.info(f"Playing file ({source.mode}): {audio_file}")
+                else:
+                    logger.info(f"Streaming ({source.mode}): {self.current.title}")
                 
                 if self.voice_client and self.voice_client.is_connected():
                     def after_playing(error):
-                        # Only clean up if not looping the song
-                        if not self.loop_song:
-                            try:
-                                if os.path.exists(audio_file):
-                                    os.remove(audio_file)
-                                    logger.info(f"Cleaned up: {audio_file}")
-                            except Exception as e:
-                                logger.error(f"Could not delete file: {e}")
-                        
+                        # The file stays in the audio cache for the next play
                         self.bot.loop.call_soon_threadsafe(self.next_event.set)
                     
+                    def audio_started(started=started, ended=self.song_ended):
+                        # Runs on the audio thread as discord sends the first frame
+                        now = self.bot.loop.time()
+                        self.bot.loop.call_soon_threadsafe(self.audio_started, started, ended, now)
+                    
+                    # A source that was faded in was heard before the last
+                    # song ended, so there was no gap at all
+                    if source.frames:
+                        if self.song_ended is not None:
+                            track_gap_seconds.observe(0.0)
+                    else:
+                        source.on_start = audio_started
+                    
+                    self.source = source
                     self.voice_client.play(source, after=after_playing)
+                    tracks_total.inc(mode=source.mode)
+                    
+                    if GAPLESS:
+                        self.preload_task = self.bot.loop.create_task(self.preload(source))
                     
                     # Build now playing embed
                     embed = discord.Embed(
@@ -184,7 +900,7 @@ class MusicPlayer:
                         mins, secs = divmod(self.current.duration, 60)
                         embed.add_field(name="duration", value=f"{int(mins)}:{int(secs):02d}", inline=True)
 
-                    embed.add_field(name="requested by", value=self.current.requester.mention, inline=True)
+                    embed.add_field(name="requested by", value=self.current.requester_mention(self.guild), inline=True)
 
                     # Show loop status
                     if self.loop_song:
@@ -197,21 +913,202 @@ class MusicPlayer:
                     
                     await self.text_channel.send(embed=embed)
                     await self.next_event.wait()
+                    self.song_ended = self.bot.loop.time()
+                    
+                    # A stream that ended without producing any audio failed
+                    # to open, so play the song again from a download
+                    source = self.source
+                    if self.current.stream_url and not audio_file and source.frames == 0 and not source.start_frame:
+                        logger.warning(f"stream produced no audio, downloading: {self.current.title}")
+                        self.current.stream_url = None
+                        self.current.stream_failed = True
+                        self.drop_preload()
+                        if not self.loop_song:
+                            self.queue.appendleft(self.current)
                     
+            except DiskQuotaError as e:
+                playback_errors_total.inc()
+                logger.error(f"no room to download {self.current.title}: {e}")
+                await self.text_channel.send(f"out of disk space, could not download: {self.current.title}")
             except Exception as e:
+                playback_errors_total.inc()
                 logger.error(f'player error: {e}')
                 await self.text_channel.send(f'error playing song, skipping...')
                 await asyncio.sleep(2)
 
+class QueueView(discord.ui.View):
+    """Buttons that page through a player's queue by editing the same message"""
+    
+    def __init__(self, player, page=0):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.player = player
+        self.page = page
+        self.message = None
+    
+    def pages(self):
+        return max(1, -(-len(self.player.queue) // QUEUE_PAGE_SIZE))
+    
+    def render(self):
+        """Build the embed for the current page and update the buttons"""
+        player = self.player
+        pages = self.pages()
+        self.page = max(0, min(self.page, pages - 1))
+        
+        embed = discord.Embed(
+            title="music queue",
+            color=discord.Color.purple()
+        )
+        
+        if player.current:
+            current_info = f"{player.current.title}\n{player.current.source}"
+            embed.add_field(
+                name="now playing",
+                value=current_info,
+                inline=False
+            )
+        
+        if player.queue:
+            embed.add_field(
+                name=f"up next ({len(player.queue)} songs)",
+                value=player.queue_page(self.page),
+                inline=False
+            )
+            embed.set_footer(text=f"page {self.page + 1}/{pages}")
+        
+        # Show loop status
+        if player.loop_song:
+            embed.description = "looping: current song"
+        elif player.loop_queue:
+            embed.description = "looping: queue"
+        
+        self.first.disabled = self.previous.disabled = self.page == 0
+        self.next.disabled = self.last.disabled = self.page >= pages - 1
+        return embed
+    
+    async def show(self, interaction):
+        await interaction.response.edit_message(embed=self.render(), view=self)
+    
+    @discord.ui.button(label="«", style=discord.ButtonStyle.secondary)
+    async def first(self, interaction, button):
+        self.page = 0
+        await self.show(interaction)
+    
+    @discord.ui.button(label="‹", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        self.page -= 1
+        await self.show(interaction)
+    
+    @discord.ui.button(label="›", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        self.page += 1
+        await self.show(interaction)
+    
+    @discord.ui.button(label="»", style=discord.ButtonStyle.secondary)
+    async def last(self, interaction, button):
+        self.page = self.pages() - 1
+        await self.show(interaction)
+    
+    async def on_timeout(self):
+        if self.player.queue_view is self:
+            self.player.queue_view = None
+        
+        try:
+            await self.message.edit(view=None)
+        except Exception:
+            pass
+
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.players = {}
+        self.streaming = {}  # guild id -> streaming setting chosen with !stream
+        self.volumes = {}  # guild id -> volume chosen with !volume
+        self.janitor_task = None
+    
+    async def cog_load(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, audio_cache.load)
+        
+        # Nothing is downloading or recording yet, so every leftover is an orphan
+        await loop.run_in_executor(None, janitor.sweep, True)
+        self.janitor_task = asyncio.create_task(self.run_janitor())
+        
+        await loop.run_in_executor(None, warm_pools)
+        collectors.append(self.collect_metrics)
+    
+    async def cog_unload(self):
+        loop = asyncio.get_running_loop()
+        collectors.remove(self.collect_metrics)
+        if self.janitor_task:
+            self.janitor_task.cancel()
+        
+        for player in list(self.players.values()):
+            self.players.pop(player.guild.id, None)
+            await player.destroy()
+        
+        loudness_analyzer.shutdown()
+        await loop.run_in_executor(None, audio_cache.save)
+        await loop.run_in_executor(None, shutdown_pools)
+    
+    async def run_janitor(self):
+        """Sweep for orphans and enforce the disk quota every JANITOR_INTERVAL"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(JANITOR_INTERVAL)
+            try:
+                await loop.run_in_executor(None, janitor.sweep)
+            except Exception as e:
+                logger.error(f"janitor sweep failed: {e}")
+    
+    def collect_metrics(self):
+        """Copy cache, pool and player stats into the metrics before a scrape"""
+        for name, stats in (('metadata', metadata_cache.stats()), ('stream', stream_cache.stats()),
+                            ('audio', audio_cache.stats())):
+            cache_requests_total.set(stats['hits'], cache=name, result='hit')
+            cache_requests_total.set(stats['misses'], cache=name, result='miss')
+        
+        for executor in (search_executor, download_executor):
+            stats = executor.stats()
+            executor_jobs.set(stats['queued'], pool=executor.name, state='queued')
+            executor_jobs.set(stats['running'], pool=executor.name, state='running')
+        
+        lengths = [len(player.queue) for player in self.players.values()]
+        players_active.set(len(lengths))
+        queued_songs.set(sum(lengths))
+        queue_songs_max.set(max(lengths, default=0))
     
     def get_player(self, ctx):
+        """Get this server's player, creating it if needed"""
         if ctx.guild.id not in self.players:
-            self.players[ctx.guild.id] = MusicPlayer(ctx)
-        return self.players[ctx.guild.id]
+            self.players[ctx.guild.id] = MusicPlayer(
+                ctx,
+                on_idle=self.remove_player,
+                streaming=self.streaming.get(ctx.guild.id, PLAYBACK_MODE == 'stream'),
+                volume=self.volumes.get(ctx.guild.id, DEFAULT_VOLUME)
+            )
+        
+        player = self.players[ctx.guild.id]
+        player.touch()
+        return player
+    
+    def remove_player(self, player):
+        """Forget a player and tear it down"""
+        if self.players.get(player.guild.id) is player:
+            del self.players[player.guild.id]
+        
+        self.bot.loop.create_task(player.destroy())
+    
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Drop the queue when the bot is disconnected, so the player goes idle"""
+        if member.id != self.bot.user.id or after.channel is not None:
+            return
+        
+        player = self.players.get(member.guild.id)
+        if player:
+            player.clear()
+            player.loop_song = False
+            player.loop_queue = False
     
     def detect_platform(self, url_or_query):
         """Detect if query is YouTube, SoundCloud, or search term"""
@@ -234,29 +1131,33 @@ class Music(commands.Cog):
     
     async def extract_info(self, query, prefer_soundcloud=False, allow_playlist=False):
         """Extract song info from various sources"""
-        loop = self.bot.loop or asyncio.get_event_loop()
+        if query.startswith('http'):
+            key = ('url', canonical_url(query), allow_playlist)
+        else:
+            key = ('search', prefer_soundcloud, normalize_query(query))
+        
+        data = metadata_cache.get(key)
+        if data is not None:
+            return data
         
         try:
-            ytdl_opts = YTDL_OPTIONS.copy()
-            ytdl_opts['noplaylist'] = not allow_playlist
-            
-            ytdl = yt_dlp.YoutubeDL(ytdl_opts)
-            
             if query.startswith('http'):
-                data = await loop.run_in_executor(
-                    None,
-                    functools.partial(ytdl.extract_info, query, download=False)
-                )
+                with Timer(search_seconds, kind='url'), span('extraction', kind='url'):
+                    data = await search_executor.run_once(key, extract, query, allow_playlist)
             else:
-                if prefer_soundcloud:
-                    search_query = f"scsearch:{query}"
-                else:
-                    search_query = f"ytsearch:{query}"
+                sites = ['soundcloud'] if prefer_soundcloud else None
+                with Timer(search_seconds, kind='search'), span('extraction', kind='search'):
+                    data = await search(query, allow_playlist, sites)
+            
+            if data and (data.get('entries') or data.get('entries') is None):
+                metadata_cache.set(key, slim_info(data))
                 
-                data = await loop.run_in_executor(
-                    None,
-                    functools.partial(ytdl.extract_info, search_query, download=False)
-                )
+                # Keep the full info of a single song around so playing it
+                # doesn't have to extract it all over again
+                if data.get('entries') is None:
+                    remember_stream(data)
+                elif not allow_playlist:
+                    remember_stream(data['entries'][0])
             
             return data
             
@@ -264,6 +1165,88 @@ class Music(commands.Cog):
             logger.error(f'Extract error: {e}')
             return None
     
+    async def open_playlist(self, url):
+        """Read the first page of a playlist, (None, None) if it isn't one or fails to load"""
+        reader = PlaylistReader(url)
+        
+        try:
+            with Timer(search_seconds, kind='playlist'), span('extraction', kind='playlist'):
+                batch = await search_executor.run(reader.read, PLAYLIST_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f'Playlist error: {e}')
+            batch = None
+        
+        if not batch:
+            reader.close()
+            return None, None
+        
+        return reader, batch
+    
+    def queue_entries(self, player, entries, requester_id, source=None):
+        """Queue flat playlist entries as placeholders that get resolved before playing"""
+        for entry in entries:
+            url = entry.get('webpage_url') or entry.get('url')
+            
+            player.queue.append(Song(
+                url=url,
+                title=entry.get('title') or 'Unknown',
+                duration=entry.get('duration'),
+                thumbnail=entry.get('thumbnail'),
+                requester_id=requester_id,
+                source=source or source_name(url),
+                cache_key=cache_key(entry),
+                resolved=False
+            ))
+        
+        player.prefetch()
+        return len(entries)
+    
+    async def queue_playlist(self, ctx, player, msg, reader, batch, title, source=None):
+        """Queue the first page of a playlist and keep loading the rest in the background"""
+        added = self.queue_entries(player, batch, ctx.author.id, source)
+        
+        embed = discord.Embed(
+            title=title,
+            description=f"added {added} songs to queue, loading the rest...",
+            color=discord.Color.green()
+        )
+        embed.add_field(name="requested by", value=ctx.author.mention)
+        await msg.edit(content=None, embed=embed)
+        
+        task = self.bot.loop.create_task(
+            self.load_playlist(player, msg, embed, reader, added, ctx.author.id, source)
+        )
+        player.playlist_tasks.add(task)
+        task.add_done_callback(player.playlist_tasks.discard)
+    
+    async def load_playlist(self, player, msg, embed, reader, added, requester_id, source):
+        """Queue the rest of a playlist a page at a time"""
+        try:
+            while added < MAX_PLAYLIST_SIZE:
+                batch = await search_executor.run(
+                    reader.read,
+                    min(PLAYLIST_BATCH_SIZE, MAX_PLAYLIST_SIZE - added)
+                )
+                if not batch:
+                    break
+                
+                added += self.queue_entries(player, batch, requester_id, source)
+        except Exception as e:
+            logger.error(f'Playlist error: {e}')
+        finally:
+            reader.close()
+        
+        embed.description = f"added {added} songs to queue"
+        if added >= MAX_PLAYLIST_SIZE:
+            embed.set_footer(text=f"playlists are limited to {MAX_PLAYLIST_SIZE} songs")
+        
+        try:
+            await msg.edit(embed=embed)
+        except discord.HTTPException:
+            pass
+        
+        logger.info(f'added playlist: {added} songs')
+    
     @commands.command(name='play', aliases=['p'])
     async def play(self, ctx, *, query: str):
         """Play a song or playlist
@@ -274,7 +1257,26 @@ class Music(commands.Cog):
         !play <soundcloud url>
         !play <youtube playlist url>
         """
+        await self.enqueue(ctx, query)
+    
+    @commands.command(name='playnext', aliases=['pn'])
+    async def playnext(self, ctx, *, query: str):
+        """Queue a song to play after the current one
+        
+        Usage:
+        !playnext <song name or url>
+        !playnext <position> - Move a queued song to the front
+        """
+        player = self.players.get(ctx.guild.id)
         
+        if query.isdigit() and player and player.queue:
+            await self.move_song(ctx, player, int(query), 1)
+            return
+        
+        await self.enqueue(ctx, query, next_up=True)
+    
+    async def enqueue(self, ctx, query, next_up=False):
+        """Look up a song or playlist and add it to the queue, at the front if next_up"""
         if not ctx.author.voice:
             await ctx.send("you need to be in a voice channel")
             return
@@ -298,9 +1300,16 @@ class Music(commands.Cog):
             else:
                 msg = await ctx.send(f"searching for: `{query[:50]}...`")
         
-        data = await self.extract_info(query, allow_playlist=is_playlist)
+        # Playlists queue their first page straight away and load the rest
+        # in the background, anything else is extracted as a single song
+        reader = batch = data = None
+        if is_playlist:
+            reader, batch = await self.open_playlist(query)
         
-        if not data:
+        if not batch:
+            data = await self.extract_info(query)
+        
+        if not batch and not data:
             error_msg = "could not find any results"
             if platform == 'YouTube' and not HAS_COOKIES:
                 error_msg += "\n\nyoutube is blocking requests. solutions:\n- use soundcloud: `!sc <song>`\n- add cookies.txt file\n- use soundcloud links instead"
@@ -311,49 +1320,20 @@ class Music(commands.Cog):
         
         if not player.voice_client or not player.voice_client.is_connected():
             try:
-                player.voice_client = await ctx.author.voice.channel.connect()
+                with span('voice connect'):
+                    player.voice_client = await ctx.author.voice.channel.connect()
                 await ctx.send(f"connected to {ctx.author.voice.channel.name}")
             except Exception as e:
                 await msg.edit(content=f"could not connect to voice: {str(e)}")
                 return
         
         # Handle playlist
-        if 'entries' in data and is_playlist:
-            entries = data['entries']
-            added_count = 0
-            
-            for entry in entries[:50]:
-                if not entry:
-                    continue
-                
-                webpage_url = entry.get('webpage_url', '')
-                if 'soundcloud' in webpage_url.lower():
-                    source = 'soundcloud'
-                elif 'youtube' in webpage_url.lower():
-                    source = 'youtube'
-                else:
-                    source = 'audio'
-                
-                song = Song(
-                    url=webpage_url or entry.get('url'),
-                    title=entry.get('title', 'Unknown'),
-                    duration=entry.get('duration'),
-                    thumbnail=entry.get('thumbnail'),
-                    requester=ctx.author,
-                    source=source
-                )
-                
-                player.queue.append(song)
-                added_count += 1
-            
-            embed = discord.Embed(
-                title="playlist added",
-                description=f"added {added_count} songs to queue",
-                color=discord.Color.green()
-            )
-            embed.add_field(name="requested by", value=ctx.author.mention)
-            await msg.edit(content=None, embed=embed)
-            logger.info(f'added playlist: {added_count} songs')
+        if batch and next_up:
+            reader.close()
+            await msg.edit(content="playlists can't be played next, use `!play` instead")
+        
+        elif batch:
+            await self.queue_playlist(ctx, player, msg, reader, batch, title="playlist added")
         
         # Handle single song
         else:
@@ -361,23 +1341,22 @@ class Music(commands.Cog):
                 data = data['entries'][0]
             
             webpage_url = data.get('webpage_url', '')
-            if 'soundcloud' in webpage_url.lower():
-                actual_source = 'soundcloud'
-            elif 'youtube' in webpage_url.lower():
-                actual_source = 'youtube'
-            else:
-                actual_source = 'audio'
             
             song = Song(
                 url=webpage_url or data.get('url'),
                 title=data.get('title', 'Unknown Title'),
                 duration=data.get('duration'),
                 thumbnail=data.get('thumbnail'),
-                requester=ctx.author,
-                source=actual_source
+                requester_id=ctx.author.id,
+                source=source_name(webpage_url),
+                cache_key=cache_key(data)
             )
             
-            player.queue.append(song)
+            if next_up:
+                player.queue.appendleft(song)
+            else:
+                player.queue.append(song)
+            player.prefetch()
             
             embed = discord.Embed(
                 title="added to queue",
@@ -386,7 +1365,7 @@ class Music(commands.Cog):
             )
 
             embed.add_field(name="source", value=song.source, inline=True)
-            embed.add_field(name="position", value=f"#{len(player.queue)}", inline=True)
+            embed.add_field(name="position", value=f"#{1 if next_up else len(player.queue)}", inline=True)
 
             if song.duration:
                 mins, secs = divmod(song.duration, 60)
@@ -444,11 +1423,11 @@ class Music(commands.Cog):
     @commands.command(name='loopstatus', aliases=['ls'])
     async def loopstatus(self, ctx):
         """Check current loop status"""
-        player = self.get_player(ctx)
+        player = self.players.get(ctx.guild.id)
         
-        if player.loop_song:
+        if player and player.loop_song:
             status = "looping: current song"
-        elif player.loop_queue:
+        elif player and player.loop_queue:
             status = "looping: queue"
         else:
             status = "loop: disabled"
@@ -461,6 +1440,38 @@ class Music(commands.Cog):
         
         await ctx.send(embed=embed)
     
+    @commands.command(name='stream')
+    async def stream(self, ctx, mode: str = None):
+        """Toggle streaming playback for this server
+        
+        Usage:
+        !stream - Toggle streaming
+        !stream on - Play songs straight from the source without downloading
+        !stream off - Download songs before playing them
+        """
+        
+        streaming = self.streaming.get(ctx.guild.id, PLAYBACK_MODE == 'stream')
+        
+        if mode is None:
+            streaming = not streaming
+        elif mode.lower() in ['on', 'enable', 'true', '1']:
+            streaming = True
+        elif mode.lower() in ['off', 'disable', 'false', '0']:
+            streaming = False
+        else:
+            await ctx.send("invalid mode — use: `!stream`, `!stream on` or `!stream off`")
+            return
+        
+        # Kept on the cog so the setting outlives idle players being removed
+        self.streaming[ctx.guild.id] = streaming
+        if ctx.guild.id in self.players:
+            self.players[ctx.guild.id].streaming = streaming
+        
+        if streaming:
+            await ctx.send("streaming: songs will play without downloading")
+        else:
+            await ctx.send("streaming disabled: songs will be downloaded before playing")
+    
     @commands.command(name='playlist', aliases=['pl'])
     async def playlist(self, ctx, *, url: str):
         """Load an entire playlist
@@ -492,12 +1503,17 @@ class Music(commands.Cog):
         else:
             msg = await ctx.send(f"searching soundcloud for: `{query[:50]}...`")
         
+        reader = batch = data = None
+        if is_playlist:
+            reader, batch = await self.open_playlist(query)
+        
         if not query.startswith('http'):
             query = f"scsearch:{query}"
         
-        data = await self.extract_info(query, prefer_soundcloud=True, allow_playlist=is_playlist)
+        if not batch:
+            data = await self.extract_info(query, prefer_soundcloud=True)
         
-        if not data:
+        if not batch and not data:
             await msg.edit(content="could not find any soundcloud results")
             return
         
@@ -505,39 +1521,18 @@ class Music(commands.Cog):
         
         if not player.voice_client or not player.voice_client.is_connected():
             try:
-                player.voice_client = await ctx.author.voice.channel.connect()
+                with span('voice connect'):
+                    player.voice_client = await ctx.author.voice.channel.connect()
             except Exception as e:
                 await msg.edit(content=f"could not connect: {str(e)}")
                 return
         
         # Handle playlist
-        if 'entries' in data and is_playlist:
-            entries = data['entries']
-            added_count = 0
-            
-            for entry in entries[:50]:
-                if not entry:
-                    continue
-                
-                song = Song(
-                    url=entry.get('webpage_url') or entry.get('url'),
-                    title=entry.get('title', 'Unknown'),
-                    duration=entry.get('duration'),
-                    thumbnail=entry.get('thumbnail'),
-                    requester=ctx.author,
-                    source='soundcloud'
-                )
-                
-                player.queue.append(song)
-                added_count += 1
-            
-            embed = discord.Embed(
-                title="soundcloud playlist added",
-                description=f"added {added_count} songs to queue",
-                color=discord.Color.green()
+        if batch:
+            await self.queue_playlist(
+                ctx, player, msg, reader, batch,
+                title="soundcloud playlist added", source='soundcloud'
             )
-            embed.add_field(name="requested by", value=ctx.author.mention)
-            await msg.edit(content=None, embed=embed)
         
         # Handle single song
         else:
@@ -549,11 +1544,13 @@ class Music(commands.Cog):
                 title=data.get('title', 'Unknown'),
                 duration=data.get('duration'),
                 thumbnail=data.get('thumbnail'),
-                requester=ctx.author,
-                source='soundcloud'
+                requester_id=ctx.author.id,
+                source='soundcloud',
+                cache_key=cache_key(data)
             )
             
             player.queue.append(song)
+            player.prefetch()
             
             embed = discord.Embed(
                 title="added to queue",
@@ -568,12 +1565,35 @@ class Music(commands.Cog):
             
             await msg.edit(content=None, embed=embed)
     
+    @commands.command(name='volume', aliases=['vol'])
+    async def volume(self, ctx, percent: int = None):
+        """Show or set this server's volume
+        
+        Usage:
+        !volume - Show the volume
+        !volume 50 - Set it, from 0 to 200 percent
+        """
+        if percent is None:
+            await ctx.send(f"volume: {self.volumes.get(ctx.guild.id, DEFAULT_VOLUME)}%")
+            return
+        
+        if not 0 <= percent <= MAX_VOLUME:
+            await ctx.send(f"pick a volume between 0 and {MAX_VOLUME}")
+            return
+        
+        # Kept on the cog so the setting outlives idle players being removed
+        self.volumes[ctx.guild.id] = percent
+        if ctx.guild.id in self.players:
+            await self.players[ctx.guild.id].set_volume(percent)
+        
+        await ctx.send(f"volume set to {percent}%")
+    
     @commands.command(name='pause')
     async def pause(self, ctx):
         """Pause the current song"""
-        player = self.get_player(ctx)
+        player = self.players.get(ctx.guild.id)
         
-        if player.voice_client and player.voice_client.is_playing():
+        if player and player.voice_client and player.voice_client.is_playing():
             player.voice_client.pause()
             await ctx.send("paused")
         else:
@@ -582,9 +1602,9 @@ class Music(commands.Cog):
     @commands.command(name='resume')
     async def resume(self, ctx):
         """Resume the paused song"""
-        player = self.get_player(ctx)
+        player = self.players.get(ctx.guild.id)
         
-        if player.voice_client and player.voice_client.is_paused():
+        if player and player.voice_client and player.voice_client.is_paused():
             player.voice_client.resume()
             await ctx.send("resumed")
         else:
@@ -593,88 +1613,196 @@ class Music(commands.Cog):
     @commands.command(name='skip', aliases=['s'])
     async def skip(self, ctx):
         """Skip the current song"""
-        player = self.get_player(ctx)
+        player = self.players.get(ctx.guild.id)
         
-        if player.voice_client and player.voice_client.is_playing():
+        if player and player.voice_client and player.voice_client.is_playing():
             player.voice_client.stop()
             await ctx.send("skipped")
         else:
             await ctx.send("nothing is playing")
     
+    async def seek_to(self, ctx, position):
+        """Move the playing song to position seconds and say where it went"""
+        player = self.players.get(ctx.guild.id)
+        
+        if not player or not player.source or not player.voice_client or not (
+            player.voice_client.is_playing() or player.voice_client.is_paused()
+        ):
+            await ctx.send("nothing is playing")
+            return
+        
+        position = max(0, position)
+        duration = player.current.duration
+        if duration and position >= duration:
+            await ctx.send(f"that's past the end of the song ({format_position(duration)})")
+            return
+        
+        if not await player.seek(position):
+            await ctx.send("could not seek in this song")
+            return
+        
+        await ctx.send(f"seeked to {format_position(position)}")
+    
+    @commands.command(name='seek')
+    async def seek(self, ctx, position: str):
+        """Jump to a position in the current song
+        
+        Usage: !seek 1:30 or !seek 90
+        """
+        seconds = parse_position(position)
+        if seconds is None:
+            await ctx.send("give a position like 90, 1:30 or 1:02:03")
+            return
+        
+        await self.seek_to(ctx, seconds)
+    
+    @commands.command(name='forward', aliases=['ff'])
+    async def forward(self, ctx, seconds: int = 10):
+        """Skip ahead in the current song, 10 seconds unless told otherwise"""
+        player = self.players.get(ctx.guild.id)
+        position = player.source.position if player and player.source else 0
+        await self.seek_to(ctx, position + seconds)
+    
+    @commands.command(name='rewind', aliases=['rw'])
+    async def rewind(self, ctx, seconds: int = 10):
+        """Go back in the current song, 10 seconds unless told otherwise"""
+        player = self.players.get(ctx.guild.id)
+        position = player.source.position if player and player.source else 0
+        await self.seek_to(ctx, position - seconds)
+    
+    @commands.command(name='skipto', aliases=['jump'])
+    async def skipto(self, ctx, position: int):
+        """Skip straight to a song in the queue"""
+        player = self.players.get(ctx.guild.id)
+        
+        if not player or not player.queue:
+            await ctx.send("queue is empty")
+            return
+        
+        if not 1 <= position <= len(player.queue):
+            await ctx.send(f"pick a position between 1 and {len(player.queue)}")
+            return
+        
+        # Songs jumped over go to the back when the queue loops, like they were played
+        if player.loop_queue:
+            player.queue.rotate(position - 1)
+        else:
+            player.queue.truncate(position - 1)
+        player.prefetch()
+        
+        song = player.queue[0]
+        message = f"skipping to: {song.title}"
+        if player.voice_client and (player.voice_client.is_playing() or player.voice_client.is_paused()):
+            # A looping song would be queued again in front of the one we jump to
+            if player.loop_song:
+                player.loop_song = False
+                message += " (song loop disabled)"
+            player.voice_client.stop()
+        
+        await ctx.send(message)
+    
+    @commands.command(name='remove', aliases=['rm'])
+    async def remove(self, ctx, position: int):
+        """Remove a song from the queue by its position"""
+        player = self.players.get(ctx.guild.id)
+        
+        if not player or not player.queue:
+            await ctx.send("queue is empty")
+            return
+        
+        if not 1 <= position <= len(player.queue):
+            await ctx.send(f"pick a position between 1 and {len(player.queue)}")
+            return
+        
+        song = player.queue.pop(position - 1)
+        player.prefetch()
+        await ctx.send(f"removed: {song.title}")
+    
+    @commands.command(name='move', aliases=['mv'])
+    async def move(self, ctx, source: int, destination: int):
+        """Move a song to another position in the queue
+        
+        Usage: !move <from> <to>
+        """
+        player = self.players.get(ctx.guild.id)
+        
+        if not player or not player.queue:
+            await ctx.send("queue is empty")
+            return
+        
+        await self.move_song(ctx, player, source, destination)
+    
+    async def move_song(self, ctx, player, source, destination):
+        if not 1 <= source <= len(player.queue) or not 1 <= destination <= len(player.queue):
+            await ctx.send(f"pick positions between 1 and {len(player.queue)}")
+            return
+        
+        song = player.queue.move(source - 1, destination - 1)
+        player.prefetch()
+        await ctx.send(f"moved {song.title} to #{destination}")
+    
+    @commands.command(name='shuffle')
+    async def shuffle(self, ctx):
+        """Shuffle the queue"""
+        player = self.players.get(ctx.guild.id)
+        
+        if not player or not player.queue:
+            await ctx.send("queue is empty")
+            return
+        
+        player.queue.shuffle()
+        player.prefetch()
+        await ctx.send(f"shuffled {len(player.queue)} songs")
+    
     @commands.command(name='stop')
     async def stop(self, ctx):
         """Stop music and disconnect"""
-        player = self.get_player(ctx)
+        player = self.players.get(ctx.guild.id)
         
-        if player.voice_client:
-            player.queue.clear()
+        if player and player.voice_client:
+            player.clear()
             player.loop_song = False
             player.loop_queue = False
             player.voice_client.stop()
             await player.voice_client.disconnect()
             
-            try:
-                if os.path.exists('downloads'):
-                    for file in os.listdir('downloads'):
-                        file_path = os.path.join('downloads', file)
-                        os.remove(file_path)
-            except Exception as e:
-                logger.error(f"Could not clean downloads: {e}")
-            
             await ctx.send("stopped and disconnected")
         else:
             await ctx.send("not connected")
     
     @commands.command(name='queue', aliases=['q'])
-    async def queue(self, ctx):
-        """Show the music queue"""
-        player = self.get_player(ctx)
+    async def queue(self, ctx, page: int = 1):
+        """Show the music queue
         
-        if not player.queue and not player.current:
+        Usage: !queue [page]
+        """
+        player = self.players.get(ctx.guild.id)
+        
+        if not player or (not player.queue and not player.current):
             await ctx.send("queue is empty")
             return
         
-        embed = discord.Embed(
-            title="music queue",
-            color=discord.Color.purple()
-        )
-        
-        if player.current:
-            current_info = f"{player.current.title}\n{player.current.source}"
-            embed.add_field(
-                name="now playing",
-                value=current_info,
-                inline=False
-            )
-        
-        if player.queue:
-            queue_list = []
-            for i, song in enumerate(list(player.queue)[:10], 1):
-                queue_list.append(f"`{i}.` {song.title}")
-            
-            embed.add_field(
-                name=f"up next ({len(player.queue)} songs)",
-                value="\n".join(queue_list),
-                inline=False
-            )
-            
-            if len(player.queue) > 10:
-                embed.set_footer(text=f"and {len(player.queue) - 10} more...")
+        # Reuse the last queue message in this channel while its buttons still work
+        view = player.queue_view
+        if view and not view.is_finished() and view.message.channel.id == ctx.channel.id:
+            view.page = page - 1
+            await view.message.edit(embed=view.render(), view=view)
+            return
         
-        # Show loop status
-        if player.loop_song:
-            embed.description = "looping: current song"
-        elif player.loop_queue:
-            embed.description = "looping: queue"
+        if view:
+            await view.on_timeout()
+            view.stop()
         
-        await ctx.send(embed=embed)
+        view = QueueView(player, page - 1)
+        view.message = await ctx.send(embed=view.render(), view=view)
+        player.queue_view = view
     
     @commands.command(name='np', aliases=['nowplaying'])
     async def nowplaying(self, ctx):
         """Show the currently playing song"""
-        player = self.get_player(ctx)
+        player = self.players.get(ctx.guild.id)
         
-        if not player.current:
+        if not player or not player.current:
             await ctx.send("nothing is playing")
             return
 
@@ -687,10 +1815,12 @@ class Music(commands.Cog):
         embed.add_field(name="source", value=player.current.source, inline=True)
 
         if player.current.duration:
-            mins, secs = divmod(player.current.duration, 60)
-            embed.add_field(name="duration", value=f"{int(mins)}:{int(secs):02d}", inline=True)
+            duration = format_position(player.current.duration)
+            if player.source:
+                duration = f"{format_position(player.source.position)} / {duration}"
+            embed.add_field(name="duration", value=duration, inline=True)
 
-        embed.add_field(name="requested by", value=player.current.requester.mention, inline=True)
+        embed.add_field(name="requested by", value=player.current.requester_mention(ctx.guild), inline=True)
 
         # Show loop status
         if player.loop_song:
@@ -703,5 +1833,65 @@ class Music(commands.Cog):
 
         await ctx.send(embed=embed)
 
+    @commands.command(name='musicstats')
+    async def musicstats(self, ctx):
+        """Show cache hit rates and extraction pool load"""
+        embed = discord.Embed(
+            title="music stats",
+            color=discord.Color.purple()
+        )
+        
+        for name, stats in (("search cache", metadata_cache.stats()), ("stream cache", stream_cache.stats())):
+            embed.add_field(
+                name=name,
+                value=f"{stats['hits']} hits, {stats['misses']} misses\n{stats['size']} entries",
+                inline=True
+            )
+        
+        audio = audio_cache.stats()
+        disk = janitor.stats()
+        embed.add_field(
+            name="audio cache",
+            value=(
+                f"{audio['hits']} hits, {audio['misses']} misses\n"
+                f"{audio['songs']} songs, {audio['bytes'] // (1024 * 1024)}/{audio['max_bytes'] // (1024 * 1024)}MB\n"
+                f"disk {disk['usage'] // (1024 * 1024)}/{disk['quota'] // (1024 * 1024)}MB, "
+                f"{disk['orphans_removed']} orphans removed"
+            ),
+            inline=True
+        )
+        
+        for executor in (search_executor, download_executor):
+            stats = executor.stats()
+            embed.add_field(
+                name=f"{executor.name} pool",
+                value=(
+                    f"{stats['running']}/{stats['workers']} busy, {stats['queued']} queued\n"
+                    f"wait avg {stats['avg_wait_ms']}ms, max {stats['max_wait_ms']}ms\n"
+                    f"{stats['coalesced']} duplicate requests shared"
+                ),
+                inline=True
+            )
+        
+        embed.add_field(
+            name="search sites",
+            value="\n".join(
+                f"{name}: {stats['state']}, tripped {stats['trips']}x"
+                for name, stats in ((name, breaker.stats()) for name, breaker in breakers.items())
+            ),
+            inline=True
+        )
+        
+        loudness = loudness_analyzer.stats()
+        embed.add_field(
+            name="loudness",
+            value=f"{loudness['analyzed']} analyzed, {loudness['pending']} pending\n{loudness['failed']} failed",
+            inline=True
+        )
+        
+        embed.add_field(name="players", value=str(len(self.players)), inline=True)
+        
+        await ctx.send(embed=embed)
+
 async def setup(bot):
     await bot.add_cog(Music(bot))
\ No newline at end of file
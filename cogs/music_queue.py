@@ -0,0 +1,222 @@
+import asyncio
+import random
+
+class Node:
+    """A song in the queue's tree, ordered by position rather than by key"""
+    
+    __slots__ = ('song', 'priority', 'size', 'left', 'right')
+    
+    def __init__(self, song, priority=None):
+        self.song = song
+        self.priority = random.random() if priority is None else priority
+        self.size = 1
+        self.left = None
+        self.right = None
+
+def size(node):
+    return node.size if node else 0
+
+def update(node):
+    node.size = 1 + size(node.left) + size(node.right)
+
+def split(node, count):
+    """Split a tree into its first count songs and the rest"""
+    if node is None:
+        return None, None
+    
+    if size(node.left) >= count:
+        left, node.left = split(node.left, count)
+        update(node)
+        return left, node
+    
+    node.right, right = split(node.right, count - size(node.left) - 1)
+    update(node)
+    return node, right
+
+def merge(left, right):
+    """Join two trees, every song in left coming before every song in right"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        update(left)
+        return left
+    
+    right.left = merge(left, right.left)
+    update(right)
+    return right
+
+def build(songs):
+    """Build a tree from songs in order in linear time"""
+    stack = []
+    for song in songs:
+        node = Node(song)
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+            update(last)
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    
+    while len(stack) > 1:
+        update(stack.pop())
+    
+    if not stack:
+        return None
+    update(stack[0])
+    return stack[0]
+
+class SongQueue:
+    """Queue of upcoming songs that the player loop can wait on
+    
+    Adding a song wakes a waiting player immediately, so idle players sleep
+    without polling. Songs are kept in an implicit treap, so looking up,
+    inserting, removing and moving songs by position are O(log n) even for
+    queues of tens of thousands of songs. version changes with every edit,
+    so views of the queue can be cached until it does.
+    """
+    
+    def __init__(self):
+        self.root = None
+        self.version = 0
+        self.not_empty = asyncio.Event()
+    
+    def __len__(self):
+        return size(self.root)
+    
+    def __bool__(self):
+        return self.root is not None
+    
+    def __iter__(self):
+        return self.islice(0, len(self))
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            songs = list(self.islice(start, stop))
+            return songs[::step] if step != 1 else songs
+        
+        node = self.root
+        index = self.position(index)
+        while node:
+            left = size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.song
+            else:
+                index -= left + 1
+                node = node.right
+    
+    def position(self, index):
+        """Turn a possibly negative index into an offset, IndexError if out of range"""
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('queue index out of range')
+        return index
+    
+    def islice(self, start, stop):
+        """Iterate over the songs from start up to stop without copying the queue"""
+        node = self.root
+        stack = []
+        index = start
+        
+        # Walk down to the first song, remembering where to continue from
+        while node:
+            left = size(node.left)
+            if index < left:
+                stack.append(node)
+                node = node.left
+            elif index == left:
+                stack.append(node)
+                break
+            else:
+                index -= left + 1
+                node = node.right
+        
+        remaining = stop - start
+        while stack and remaining > 0:
+            node = stack.pop()
+            yield node.song
+            remaining -= 1
+            
+            node = node.right
+            while node:
+                stack.append(node)
+                node = node.left
+    
+    def append(self, song):
+        self.root = merge(self.root, Node(song))
+        self.version += 1
+        self.not_empty.set()
+    
+    def appendleft(self, song):
+        self.root = merge(Node(song), self.root)
+        self.version += 1
+        self.not_empty.set()
+    
+    def insert(self, index, song):
+        """Insert a song before index, clamped to the ends of the queue"""
+        index = max(0, min(index, len(self)))
+        left, right = split(self.root, index)
+        self.root = merge(merge(left, Node(song)), right)
+        self.version += 1
+        self.not_empty.set()
+    
+    def pop(self, index=-1):
+        """Remove and return the song at index"""
+        index = self.position(index)
+        left, rest = split(self.root, index)
+        node, right = split(rest, 1)
+        self.root = merge(left, right)
+        self.version += 1
+        if self.root is None:
+            self.not_empty.clear()
+        return node.song
+    
+    def popleft(self):
+        if self.root is None:
+            raise IndexError('pop from an empty queue')
+        return self.pop(0)
+    
+    def move(self, source, destination):
+        """Move the song at source so it ends up at destination, returning it"""
+        song = self.pop(source)
+        self.insert(destination, song)
+        return song
+    
+    def rotate(self, count):
+        """Move the first count songs to the end of the queue"""
+        left, right = split(self.root, count)
+        self.root = merge(right, left)
+        self.version += 1
+    
+    def truncate(self, count):
+        """Drop the first count songs"""
+        _, self.root = split(self.root, count)
+        self.version += 1
+        if self.root is None:
+            self.not_empty.clear()
+    
+    def shuffle(self):
+        songs = list(self)
+        random.shuffle(songs)
+        self.root = build(songs)
+        self.version += 1
+    
+    def clear(self):
+        self.root = None
+        self.not_empty.clear()
+        self.version += 1
+    
+    async def wait(self):
+        """Wait until there is at least one song in the queue"""
+        while self.root is None:
+            await self.not_empty.wait()
@@ -0,0 +1,137 @@
+import array
+import mmap
+import os
+import struct
+import tempfile
+
+import discord
+
+# Opus packets of a whole song as discord sends them, one 20ms frame each,
+# followed by an index of where every frame starts:
+#
+#   MAGIC | packet 0 | packet 1 | ... | offsets (count + 1, native u64) | FOOTER
+#
+# Playing one back is just slicing the memory mapped file, no FFmpeg
+STORE_SUFFIX = '.frames'
+MAGIC = b'OPUSFRM1'
+FOOTER = struct.Struct('<QQ8s')  # index offset, frame count, MAGIC
+INDEX_ITEMSIZE = array.array('Q').itemsize
+
+# Ogg headers FFmpeg sends ahead of the audio, they aren't frames
+HEADER_PACKETS = (b'OpusHead', b'OpusTags')
+
+FRAME_SECONDS = 0.02
+
+class OpusStoreError(Exception):
+    pass
+
+def store_key(key, gain=0.0):
+    """The audio cache key of a song's frame store, recorded with gain dB applied"""
+    if not key:
+        return None
+    if gain:
+        return f"{key}.gain{gain:+.1f}{STORE_SUFFIX}"
+    return f"{key}{STORE_SUFFIX}"
+
+class OpusStoreWriter:
+    """Writes the frames of a song as they are played (blocking)
+    
+    Frames go to a temporary file in directory that only becomes the store
+    once finish() is called, so a song that was skipped halfway is never
+    kept. The file is opened on the first frame, on the thread playing it.
+    """
+    
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix
+        self.path = None
+        self.file = None
+        self.offsets = array.array('Q', [len(MAGIC)])
+    
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix=self.prefix, suffix=STORE_SUFFIX + '.part', dir=self.directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.file.write(MAGIC)
+    
+    def write(self, packet):
+        if packet.startswith(HEADER_PACKETS):
+            return
+        if self.file is None:
+            self.open()
+        self.file.write(packet)
+        self.offsets.append(self.offsets[-1] + len(packet))
+    
+    def finish(self, path):
+        """Write the index and move the store into place"""
+        if self.file is None:
+            self.open()
+        index_offset = self.offsets[-1]
+        self.offsets.tofile(self.file)
+        self.file.write(FOOTER.pack(index_offset, len(self.offsets) - 1, MAGIC))
+        self.file.close()
+        os.replace(self.path, path)
+    
+    def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class OpusStoreSource(discord.AudioSource):
+    """Plays a frame store straight from a memory map
+    
+    The index makes seeking to any frame instant, so a song can start from
+    any position exactly.
+    """
+    
+    def __init__(self, path, start=0):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        try:
+            if len(self.map) < len(MAGIC) + FOOTER.size or self.map[:len(MAGIC)] != MAGIC:
+                raise OpusStoreError(f"not a frame store: {path}")
+            
+            index_offset, count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+            index_end = index_offset + (count + 1) * INDEX_ITEMSIZE
+            if magic != MAGIC or index_end != len(self.map) - FOOTER.size:
+                raise OpusStoreError(f"truncated frame store: {path}")
+        except Exception:
+            self.map.close()
+            raise
+        
+        self.data = memoryview(self.map)
+        self.offsets = self.data[index_offset:index_end].cast('Q')
+        self.count = count
+        self.position = 0
+        self.seek(start)
+    
+    @property
+    def duration(self):
+        return self.count * FRAME_SECONDS
+    
+    def seek(self, frame):
+        """Continue playing from a frame"""
+        self.position = max(0, min(int(frame), self.count))
+    
+    def read(self):
+        if self.position >= self.count:
+            return b''
+        start = self.offsets[self.position]
+        end = self.offsets[self.position + 1]
+        self.position += 1
+        return self.data[start:end].tobytes()
+    
+    def is_opus(self):
+        return True
+    
+    def cleanup(self):
+        if self.map.closed:
+            return
+        self.offsets.release()
+        self.data.release()
+        self.map.close()
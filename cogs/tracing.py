@@ -0,0 +1,172 @@
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import discord
+from discord.ext import commands
+
+logger = logging.getLogger('Tracing')
+
+# Record where the time goes in every command, off unless turned on
+TRACE_COMMANDS = os.getenv('TRACE_COMMANDS', 'false').lower() not in ('0', 'false', 'no', 'off')
+
+# Commands slower than this many milliseconds are kept for !trace
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '20'))
+
+# The trace of the command being handled, followed into everything it awaits
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# Most recent slow commands, oldest first
+slow_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+class Trace:
+    """Timed steps of handling one command message"""
+    
+    def __init__(self, message):
+        self.guild_id = message.guild.id if message.guild else None
+        self.guild_name = message.guild.name if message.guild else 'dm'
+        self.command = None
+        self.started = time.perf_counter()
+        self.last_mark = self.started
+        self.wall_time = time.time()
+        self.spans = []  # (name, offset from start, duration, tags)
+        self.duration = None
+    
+    @property
+    def finished(self):
+        return self.duration is not None
+    
+    def tags(self):
+        return {'guild': self.guild_id, 'command': self.command}
+    
+    def add(self, name, start, end, **tags):
+        if not self.finished:
+            self.spans.append((name, start - self.started, end - start, {**self.tags(), **tags}))
+    
+    def mark(self, name, **tags):
+        """Record a span from the previous mark until now"""
+        now = time.perf_counter()
+        self.add(name, self.last_mark, now, **tags)
+        self.last_mark = now
+    
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+    
+    def format(self):
+        lines = [f"`!{self.command}` in {self.guild_name}: {self.duration * 1000:.0f}ms, <t:{int(self.wall_time)}:R>"]
+        for name, offset, duration, tags in self.spans:
+            extra = ', '.join(f"{key}={value}" for key, value in tags.items() if key not in ('guild', 'command'))
+            lines.append(
+                f"`+{offset * 1000:6.0f}ms {duration * 1000:6.0f}ms` {name}" + (f" ({extra})" if extra else "")
+            )
+        return "\n".join(lines)
+
+def start_trace(message):
+    """Start tracing a message if tracing is on, returning the trace or None"""
+    if not TRACE_COMMANDS:
+        return None
+    
+    trace = Trace(message)
+    current_trace.set(trace)
+    return trace
+
+def finish_trace(trace):
+    """Close a trace, keeping it if the command was slow"""
+    if trace is None or trace.finished:
+        return
+    
+    trace.finish()
+    current_trace.set(None)
+    
+    # Messages that weren't commands aren't interesting
+    if trace.command is None:
+        return
+    
+    if trace.duration * 1000 >= TRACE_SLOW_MS:
+        slow_traces.append(trace)
+        logger.info(f"slow command !{trace.command} in {trace.guild_name}: {trace.duration * 1000:.0f}ms")
+
+def mark(name, **tags):
+    """Close a span on the current trace running from its previous mark until now"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.mark(name, **tags)
+
+@contextmanager
+def span(name, **tags):
+    """Time a block as a span of the current command, if it is being traced"""
+    trace = current_trace.get()
+    if trace is None or trace.finished:
+        yield
+        return
+    
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter(), **tags)
+
+class Tracing(commands.Cog):
+    """Shows the slowest recent commands, step by step"""
+    
+    def __init__(self, bot):
+        self.bot = bot
+        self.original_request = None
+    
+    async def cog_load(self):
+        if not TRACE_COMMANDS:
+            return
+        
+        # Every Discord API call goes through the http client, so wrapping
+        # its request method times sends and edits without touching callers
+        self.original_request = self.bot.http.request
+        original = self.original_request
+        
+        async def request(route, **kwargs):
+            with span(f"discord {route.method} {route.path}"):
+                return await original(route, **kwargs)
+        
+        self.bot.http.request = request
+        logger.info(f"tracing commands, keeping those slower than {TRACE_SLOW_MS:.0f}ms")
+    
+    async def cog_unload(self):
+        if self.original_request is not None:
+            self.bot.http.request = self.original_request
+    
+    @commands.command(name='trace')
+    @commands.has_permissions(administrator=True)
+    async def trace(self, ctx, count: int = 3):
+        """Show the most recent slow commands (Admin only)
+        
+        Usage: !trace [count]
+        """
+        if not TRACE_COMMANDS:
+            await ctx.send("tracing is off — set TRACE_COMMANDS=1 to turn it on")
+            return
+        
+        if not slow_traces:
+            await ctx.send(f"no commands slower than {TRACE_SLOW_MS:.0f}ms yet")
+            return
+        
+        embed = discord.Embed(
+            title="slow commands",
+            color=discord.Color.purple()
+        )
+        
+        for trace in list(slow_traces)[-max(1, min(count, 10)):][::-1]:
+            embed.add_field(name="\u200b", value=trace.format()[:1024], inline=False)
+        
+        embed.set_footer(text=f"{len(slow_traces)} kept, slower than {TRACE_SLOW_MS:.0f}ms")
+        await ctx.send(embed=embed)
+    
+    @trace.error
+    async def trace_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            await ctx.send("you need administrator permissions to use this command")
+
+async def setup(bot):
+    await bot.add_cog(Tracing(bot))
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from discord.ext import commands
+
+from cogs.metrics import loop_lag_seconds, loop_stalls_total
+
+logger = logging.getLogger('Watchdog')
+
+# How often the event loop is checked, and how late a check can be before
+# it counts as a stall and the blocking code's stack gets logged, in seconds
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))
+
+class Watchdog(commands.Cog):
+    """Measures event loop lag and logs what was holding the loop when it stalls
+    
+    A task on the loop ticks every LOOP_LAG_INTERVAL and records how late it
+    woke up. A separate thread watches those ticks, and when they stop for
+    longer than LOOP_LAG_THRESHOLD it grabs the loop thread's stack while
+    the blocking call is still running, which points straight at it.
+    """
+    
+    def __init__(self, bot):
+        self.bot = bot
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+    
+    async def cog_load(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stopped.clear()
+        
+        self.task = asyncio.create_task(self.measure_lag())
+        self.thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+    
+    async def cog_unload(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+    
+    async def measure_lag(self):
+        """Sleep for a fixed interval and record how much longer it took"""
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            self.last_tick = now
+            
+            lag = max(0.0, now - start - LOOP_LAG_INTERVAL)
+            loop_lag_seconds.observe(lag)
+            if lag >= LOOP_LAG_THRESHOLD:
+                loop_stalls_total.inc()
+                logger.warning(f"event loop was blocked for {lag * 1000:.0f}ms")
+    
+    def watch(self):
+        """Runs in its own thread, capturing the loop's stack once per stall"""
+        captured = None  # The tick a stack was already logged for
+        
+        while not self.stopped.wait(LOOP_LAG_INTERVAL):
+            tick = self.last_tick
+            stalled = time.monotonic() - tick - LOOP_LAG_INTERVAL
+            
+            if stalled < LOOP_LAG_THRESHOLD or captured == tick:
+                continue
+            
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            
+            captured = tick
+            stack = ''.join(traceback.format_stack(frame))
+            del frame
+            logger.warning(f"event loop blocked for {stalled * 1000:.0f}ms so far, it is running:\n{stack}")
+
+async def setup(bot):
+    await bot.add_cog(Watchdog(bot))